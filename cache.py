@@ -0,0 +1,411 @@
+import asyncio
+import json
+
+from collections import OrderedDict
+from contextvars import Context
+from time        import monotonic
+from typing      import TYPE_CHECKING, Any, Awaitable, Callable, Hashable, Iterable
+from uuid        import uuid4
+
+from loguru              import logger
+from sqlalchemy          import Executable, Table
+from sqlalchemy.sql.util import find_tables
+
+from .codec              import Codec
+
+if TYPE_CHECKING:
+	from redis.asyncio.client import Redis
+
+
+class StatementCache:
+	"""
+	pre-built parameterized statements
+	keyed by (Model subclass, operation, field set)
+	"""
+	_statements : dict[Hashable, Executable] = {}
+	hits        : int = 0
+	misses      : int = 0
+
+	@staticmethod
+	def get(key: Hashable, build: Callable[[], Executable]) -> Executable:
+		statement = StatementCache._statements.get(key)
+		if statement is None:
+			StatementCache.misses += 1
+			statement = StatementCache._statements[key] = build()
+		else:
+			StatementCache.hits += 1
+		return statement
+
+	@staticmethod
+	def stats() -> dict[str, Any]:
+		total = StatementCache.hits + StatementCache.misses
+		return {
+			'size'     : len(StatementCache._statements),
+			'hits'     : StatementCache.hits,
+			'misses'   : StatementCache.misses,
+			'hit_rate' : StatementCache.hits / total if total else 0.0
+		}
+
+	@staticmethod
+	def clear():
+		StatementCache._statements.clear()
+		StatementCache.hits   = 0
+		StatementCache.misses = 0
+
+
+class RecordCache:
+	"""
+	read-through cache of Model records keyed by pk and unique fields:
+	in-process LRU with TTL and optional Redis tier (records as json, see Codec),
+	with the Redis tier on, writes drop the record from the local tier of other nodes
+	by pubsub on `{prefix}:{name}:invalidate`, messages missed while a node
+	resubscribes leave its local copy stale for up to `ttl`
+
+	class User(Base, Model):
+		__unique_fields__ = ('email',)
+		__record_cache__  = RecordCache(size=10_000, ttl=30)
+	"""
+	def __init__(self,
+		size   : int     = 10_000,
+		ttl    : float   = 60,
+		redis  : 'Redis' = None,
+		prefix : str     = 'record'
+	):
+		self.size          = size
+		self.ttl           = ttl
+		self.redis         = redis
+		self.prefix        = prefix
+		self.name          = None
+		self.pk_field      = None
+		self.unique_fields = ()
+		self.factory       : Callable[[dict], dict] = dict # builds records loaded from redis
+		self.generation    = 0 # bumped on every write, guards puts of reads started before it
+
+		self._records  : OrderedDict[Any, tuple[float, dict]] = OrderedDict() # pk: (expires, record)
+		self._index    : OrderedDict[tuple, tuple[float, Any]] = OrderedDict() # (field, value): (expires, pk)
+		self._node     = uuid4().hex # skips own invalidations
+		self._listener : asyncio.Task | None = None
+
+		self.hits       = 0
+		self.misses     = 0
+		self.evictions  = 0
+		self.redis_hits = 0
+
+	def bind(self,
+		name          : str,
+		pk_field      : str,
+		unique_fields : tuple[str, ...],
+		factory       : Callable[[dict], dict] = dict
+	):
+		self.name          = name
+		self.pk_field      = pk_field
+		self.unique_fields = tuple(unique_fields)
+		self.factory       = factory
+
+	def is_key(self, field: str) -> bool:
+		return field == self.pk_field or field in self.unique_fields
+
+	#################### LOCAL TIER ####################
+
+	def _local_get(self, field: str, value: Any) -> dict | None:
+		now = monotonic()
+		pk  = value
+		if field != self.pk_field:
+			entry = self._index.get((field, value))
+			if entry is None:
+				return None
+			if entry[0] < now:
+				del self._index[(field, value)]
+				return None
+			pk = entry[1]
+
+		entry = self._records.get(pk)
+		if entry is None:
+			return None
+		if entry[0] < now:
+			del self._records[pk]
+			return None
+
+		record = entry[1]
+		if record.get(field) != value: # unique value changed since indexing
+			return None
+		self._records.move_to_end(pk)
+		return record
+
+	def _local_put(self, record: dict):
+		pk      = record[self.pk_field]
+		expires = monotonic() + self.ttl
+
+		self._records[pk] = (expires, record)
+		self._records.move_to_end(pk)
+		for field in self.unique_fields:
+			key = (field, record.get(field))
+			self._index[key] = (expires, pk)
+			self._index.move_to_end(key)
+
+		while len(self._records) > self.size:
+			self._records.popitem(last=False)
+			self.evictions += 1
+		while len(self._index) > self.size * max(len(self.unique_fields), 1):
+			self._index.popitem(last=False)
+
+	#################### REDIS TIER ####################
+
+	def _key(self, *parts: Any) -> str:
+		return ':'.join(str(p) for p in (self.prefix, self.name, *parts))
+
+	async def _redis_get(self, field: str, value: Any) -> dict | None:
+		pk = value
+		if field != self.pk_field:
+			raw = await self.redis.get(self._key(field, value))
+			if raw is None:
+				return None
+			pk = Codec.load(json.loads(raw))
+
+		raw = await self.redis.get(self._key(pk))
+		if raw is None:
+			return None
+		record = self.factory({k: Codec.load(v) for k, v in json.loads(raw).items()})
+		return record if record.get(field) == value else None
+
+	def _listen(self):
+		if self._listener is None or self._listener.done():
+			self._listener = Context().run(asyncio.ensure_future, self._subscribe())
+
+	async def _subscribe(self):
+		"""
+		drops records written on other nodes from the local tier
+		"""
+		while True:
+			pubsub = self.redis.pubsub()
+			try:
+				await pubsub.subscribe(self._key('invalidate'))
+				async for message in pubsub.listen():
+					if message['type'] != 'message':
+						continue
+					node, pk = json.loads(message['data'])
+					if node != self._node:
+						self.generation += 1
+						self._records.pop(Codec.load(pk), None)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f'Record cache {self.name} invalidation listener error: {e}')
+				await asyncio.sleep(1)
+			finally:
+				await pubsub.aclose()
+
+	async def _publish_invalidation(self, pk: Any):
+		try:
+			await self.redis.publish(self._key('invalidate'), json.dumps([self._node, Codec.dump(pk)]))
+		except TypeError as e:
+			logger.warning(f'Record {self.name} {pk} invalidation is not published: {e}')
+
+	async def _redis_put(self, record: dict):
+		ttl = int(self.ttl * 1000)
+		pk  = record[self.pk_field]
+		try:
+			data = json.dumps({k: Codec.dump(v) for k, v in record.items()})
+		except TypeError as e:
+			logger.warning(f'Record {self.name} {pk} is kept out of redis: {e}')
+			return
+
+		pipe = self.redis.pipeline(transaction=False)
+		pipe.set(self._key(pk), data, px=ttl)
+		for field in self.unique_fields:
+			pipe.set(self._key(field, record.get(field)), json.dumps(Codec.dump(pk)), px=ttl)
+		await pipe.execute()
+
+	#################### INTERFACE ####################
+
+	async def get(self, field: str, value: Any) -> dict | None:
+		if self.redis is not None:
+			self._listen()
+		record = self._local_get(field, value)
+		if record is None and self.redis is not None:
+			if record := await self._redis_get(field, value):
+				self.redis_hits += 1
+				self._local_put(record)
+		if record is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return record.copy()
+
+	async def put(self, record: dict, generation: int = None):
+		"""
+		:generation `self.generation` read before loading the record,
+		            the put is skipped when a write happened meanwhile,
+		            None for records written right now
+		"""
+		if generation is None:
+			self.generation += 1
+		elif generation != self.generation:
+			return
+		record = record.copy()
+		self._local_put(record)
+		if self.redis is not None:
+			self._listen()
+			await self._redis_put(record)
+			if generation is None:
+				await self._publish_invalidation(record[self.pk_field])
+
+	async def invalidate(self, pk: Any):
+		self.generation += 1
+		self._records.pop(pk, None)
+		if self.redis is not None:
+			self._listen()
+			await self.redis.delete(self._key(pk))
+			await self._publish_invalidation(pk)
+
+	async def close(self):
+		"""
+		stops listening to invalidations of other nodes
+		"""
+		if self._listener is not None:
+			self._listener.cancel()
+			try:
+				await self._listener
+			except asyncio.CancelledError:
+				pass
+			self._listener = None
+
+	def clear(self):
+		self._records.clear()
+		self._index.clear()
+
+	def stats(self) -> dict[str, Any]:
+		total = self.hits + self.misses
+		return {
+			'size'       : len(self._records),
+			'hits'       : self.hits,
+			'misses'     : self.misses,
+			'evictions'  : self.evictions,
+			'redis_hits' : self.redis_hits,
+			'hit_rate'   : self.hits / total if total else 0.0
+		}
+
+
+class ResultCache:
+	"""
+	TTL + LRU cache of query results keyed by compiled SQL and parameters,
+	entries are tagged by tables of the query and dropped on writes to them,
+	concurrent misses of the same key share one query
+
+	class Country(Base, Model):
+		__result_cache__ = ResultCache(size=1000, ttl=5)
+	"""
+	_instances : list['ResultCache'] = []
+
+	def __init__(self, size: int = 1000, ttl: float = 5):
+		self.size = size
+		self.ttl  = ttl
+
+		self._entries    : OrderedDict[tuple, tuple[float, frozenset, Any]] = OrderedDict() # key: (expires, tables, value)
+		self._tags       : dict[str, set[tuple]]        = {} # table: keys
+		self._inflight   : dict[tuple, asyncio.Task]    = {}
+		self._generation = 0 # bumped on invalidation, guards in-flight loads
+
+		self.hits          = 0
+		self.misses        = 0
+		self.coalesced     = 0
+		self.evictions     = 0
+		self.invalidations = 0
+
+		ResultCache._instances.append(self)
+
+	@staticmethod
+	def tables(query: Executable) -> frozenset[str]:
+		return frozenset(t.name for t in find_tables(query) if isinstance(t, Table))
+
+	@staticmethod
+	def key(query: Executable, params: dict | None, dialect: Any) -> tuple:
+		compiled = query.compile(dialect=dialect)
+		return str(compiled), repr(sorted({**compiled.params, **(params or {})}.items()))
+
+	@staticmethod
+	def invalidate_tables(tables: Iterable[str]):
+		for cache in ResultCache._instances:
+			cache.invalidate(tables)
+
+	def invalidate(self, tables: Iterable[str]):
+		self._generation += 1
+		for table in tables:
+			for key in self._tags.pop(table, ()):
+				if self._entries.pop(key, None) is not None:
+					self.invalidations += 1
+
+	def _drop(self, key: tuple, tables: frozenset):
+		for table in tables:
+			if keys := self._tags.get(table):
+				keys.discard(key)
+
+	def _store(self, key: tuple, tables: frozenset, value: Any):
+		self._entries[key] = (monotonic() + self.ttl, tables, value)
+		self._entries.move_to_end(key)
+		for table in tables:
+			self._tags.setdefault(table, set()).add(key)
+		while len(self._entries) > self.size:
+			old_key, (_, old_tables, _) = self._entries.popitem(last=False)
+			self._drop(old_key, old_tables)
+			self.evictions += 1
+
+	async def fetch(self,
+		query   : Executable,
+		params  : dict | None,
+		dialect : Any,
+		load    : Callable[[], Awaitable[Any]]
+	) -> Any:
+		key = self.key(query, params, dialect)
+
+		if entry := self._entries.get(key):
+			if entry[0] >= monotonic():
+				self.hits += 1
+				self._entries.move_to_end(key)
+				return entry[2]
+			del self._entries[key]
+			self._drop(key, entry[1])
+
+		if task := self._inflight.get(key):
+			self.coalesced += 1
+			return await asyncio.shield(task)
+
+		self.misses += 1
+		task = self._inflight[key] = asyncio.ensure_future(
+			self._load(key, self.tables(query), self._generation, load)
+		)
+		task.add_done_callback(lambda t: t.cancelled() or t.exception()) # failures reach awaiters only
+		return await asyncio.shield(task)
+
+	async def _load(self,
+		key        : tuple,
+		tables     : frozenset,
+		generation : int,
+		load       : Callable[[], Awaitable[Any]]
+	) -> Any:
+		"""
+		runs in its own task, so a cancelled caller leaves it to the others
+		"""
+		try:
+			value = await load()
+		finally:
+			del self._inflight[key]
+		if generation == self._generation:
+			self._store(key, tables, value)
+		return value
+
+	def clear(self):
+		self._entries.clear()
+		self._tags.clear()
+
+	def stats(self) -> dict[str, Any]:
+		total = self.hits + self.misses + self.coalesced
+		return {
+			'size'          : len(self._entries),
+			'hits'          : self.hits,
+			'misses'        : self.misses,
+			'coalesced'     : self.coalesced,
+			'evictions'     : self.evictions,
+			'invalidations' : self.invalidations,
+			'hit_rate'      : (self.hits + self.coalesced) / total if total else 0.0
+		}
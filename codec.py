@@ -0,0 +1,52 @@
+import base64
+
+from datetime import date, datetime, time
+from decimal  import Decimal
+from typing   import Any
+from uuid     import UUID
+
+
+class Codec:
+	"""
+	json-safe values: types json has no notion of are tagged as {tag: raw},
+	plain dicts are tagged too, so they never clash with tagged values
+
+	Codec.load(json.loads(json.dumps(Codec.dump(value)))) == value
+	"""
+	types = {
+		'datetime' : (datetime, datetime.isoformat,                         datetime.fromisoformat),
+		'date'     : (date,     date.isoformat,                             date.fromisoformat),
+		'time'     : (time,     time.isoformat,                             time.fromisoformat),
+		'uuid'     : (UUID,     str,                                        UUID),
+		'decimal'  : (Decimal,  str,                                        Decimal),
+		'bytes'    : (bytes,    lambda v: base64.b64encode(v).decode(),     base64.b64decode),
+		'json'     : (dict,     lambda v: v,                                lambda v: v)
+	}
+
+	@staticmethod
+	def dump(value: Any) -> Any:
+		"""
+		raises TypeError for values of unsupported types
+		"""
+		if value is None or isinstance(value, (str, int, float)):
+			return value
+		if isinstance(value, (list, tuple)):
+			return [Codec.dump(v) for v in value]
+		for name, (_type, dump, _) in Codec.types.items():
+			if isinstance(value, _type):
+				return {name: dump(value)}
+		raise TypeError(f'Unsupported value type: {type(value).__name__}')
+
+	@staticmethod
+	def load(value: Any) -> Any:
+		"""
+		raises KeyError / ValueError for unknown tags and malformed values
+		"""
+		if isinstance(value, dict):
+			if len(value) != 1:
+				raise ValueError('Malformed tagged value')
+			(name, raw), = value.items()
+			return Codec.types[name][2](raw)
+		if isinstance(value, list):
+			return [Codec.load(v) for v in value]
+		return value
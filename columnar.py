@@ -0,0 +1,66 @@
+from datetime import date, datetime, timezone
+from decimal  import Decimal
+from typing   import Any, Sequence
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import pyarrow
+except ImportError:
+	pyarrow = None
+
+
+class Columnar:
+	"""
+	column-oriented result sets: {column: values}
+	built straight from row tuples, without per-row dicts
+	"""
+
+	@staticmethod
+	def from_rows(keys: Sequence[str], rows: Sequence[tuple]) -> dict[str, list]:
+		if not rows:
+			return {k: [] for k in keys}
+		return {k: list(values) for k, values in zip(keys, zip(*rows))}
+
+	@staticmethod
+	def _array(values: list) -> Any:
+		sample   = next((v for v in values if v is not None), None)
+		has_null = any(v is None for v in values)
+
+		if isinstance(sample, bool) and not has_null:
+			return numpy.array(values, dtype=bool)
+		if isinstance(sample, int) and not isinstance(sample, bool):
+			if has_null:
+				return numpy.array([numpy.nan if v is None else v for v in values], dtype=float)
+			return numpy.array(values, dtype=numpy.int64)
+		if isinstance(sample, (float, Decimal)):
+			return numpy.array([numpy.nan if v is None else float(v) for v in values], dtype=float)
+		if isinstance(sample, datetime):
+			return numpy.array([
+				None if v is None else (
+					v.astimezone(timezone.utc).replace(tzinfo=None) if v.tzinfo else v
+				)
+				for v in values
+			], dtype='datetime64[us]')
+		if isinstance(sample, date):
+			return numpy.array(values, dtype='datetime64[D]')
+		return numpy.array(values, dtype=object)
+
+	@staticmethod
+	def to_numpy(columns: dict[str, list]) -> dict[str, Any]:
+		"""
+		int, float, Decimal, bool, date and datetime columns become typed arrays
+		(NULLs as nan / NaT, aware datetimes in naive UTC), others object arrays
+		"""
+		if numpy is None:
+			raise ImportError('numpy is required for columnar numpy output')
+		return {name: Columnar._array(values) for name, values in columns.items()}
+
+	@staticmethod
+	def to_arrow(columns: dict[str, list]) -> Any:
+		if pyarrow is None:
+			raise ImportError('pyarrow is required for columnar arrow output')
+		return pyarrow.table(columns)
@@ -1,50 +1,339 @@
-from typing     import Any
+import json
 
+from contextlib  import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from itertools   import count
+from time        import monotonic, perf_counter
+from typing      import Any, AsyncIterator, Awaitable, Callable, Iterable
+
+from loguru     import logger
 from sqlalchemy import (
 	CursorResult,
 	Insert,
 	Select,
 	Update,
-	func
+	func,
+	select,
+	text
 )
 from sqlalchemy.ext.asyncio        import create_async_engine
-from sqlalchemy.ext.asyncio.engine import AsyncEngine
+from sqlalchemy.ext.asyncio.engine import AsyncConnection, AsyncEngine
+
+from .columnar import Columnar
+from .metrics  import DbMetrics, QueryInfo
 
 
 class Db:
-	engine : AsyncEngine
+	engine         : AsyncEngine
+	replicas       : list[AsyncEngine] = []
+	replica_policy : str               = 'round_robin' # round_robin | least_busy
+	sticky_seconds : float             = 0
+	metrics        : DbMetrics | None  = None
+
+	_connection : ContextVar[AsyncConnection | None] = ContextVar('db_connection', default=None)
+	_last_write : ContextVar[float]                  = ContextVar('db_last_write', default=0.0)
+	_on_commit  : ContextVar[list | None]            = ContextVar('db_on_commit', default=None)
+	_caller     : ContextVar[tuple | None]           = ContextVar('db_caller', default=None)
+	_turn       = count()
 
 	@staticmethod
-	async def fetch_one(query: Select | Insert | Update) -> dict[str, Any] | None:
+	@asynccontextmanager
+	async def session() -> AsyncIterator[AsyncConnection]:
+		"""
+		unit of work: all Db/Model calls inside the scope share
+		one connection and one transaction, committed on exit
+		and rolled back on exception, nested scopes join the outer one
+
+		async with Db.session():
+			user = await User.create(...)
+			await Profile.create({'user_id': user['id']})
+
+		do not run queries of one session concurrently (asyncio.gather),
+		a connection executes one statement at a time
+		"""
+		if conn := Db._connection.get():
+			yield conn
+			return
+		callbacks = []
 		async with Db.engine.begin() as conn:
-			cursor: CursorResult = await conn.execute(query)
-			return cursor.first()._asdict() if cursor.rowcount > 0 else None
+			token     = Db._connection.set(conn)
+			on_commit = Db._on_commit.set(callbacks)
+			try:
+				yield conn
+			finally:
+				Db._on_commit.reset(on_commit)
+				Db._connection.reset(token)
+		for callback in callbacks:
+			try:
+				await callback()
+			except Exception as e:
+				logger.error(f'After commit callback error: {e}')
 
 	@staticmethod
-	async def fetch_all(query: Select | Insert | Update) -> list[dict[str, Any]]:
-		async with Db.engine.begin() as conn:
-			cursor: CursorResult = await conn.execute(query)
-			return [r._asdict() for r in cursor.all()]
+	def in_session() -> bool:
+		return Db._connection.get() is not None
 
 	@staticmethod
-	async def fetch_exists(query: Select) -> bool:
-		async with Db.engine.begin() as conn:
-			cursor: CursorResult = await conn.execute(query)
-			return bool(cursor.scalar())
+	async def after_commit(callback: Callable[[], Awaitable]):
+		"""
+		runs `callback` once the current Db.session() commits, never on rollback,
+		right away outside of a session, e.g. to drop cache entries
+		not before other connections can read the new rows
+		"""
+		if (callbacks := Db._on_commit.get()) is not None:
+			callbacks.append(callback)
+		else:
+			await callback()
+
+	#################### ROUTING ####################
 
 	@staticmethod
-	async def fetch_count(query: Select) -> int:
-		async with Db.engine.begin() as conn:
-			count_query = query.with_only_columns(func.count()).order_by(None)
-			cursor: CursorResult = await conn.execute(count_query)
-			count = cursor.scalar()
-			return count if count is not None else 0
+	def is_read(query: Any) -> bool:
+		return isinstance(query, Select) and query._for_update_arg is None
 
 	@staticmethod
-	async def execute(query: Insert | Update) -> None:
-		async with Db.engine.begin() as conn:
-			await conn.execute(query)
+	def _replica() -> AsyncEngine:
+		if Db.replica_policy == 'least_busy':
+			return min(
+				Db.replicas,
+				key=lambda e: getattr(e.sync_engine.pool, 'checkedout', lambda: 0)()
+			)
+		return Db.replicas[next(Db._turn) % len(Db.replicas)]
+
+	@staticmethod
+	def is_sticky() -> bool:
+		"""
+		this context wrote less than `sticky_seconds` ago
+		"""
+		return bool(Db.sticky_seconds) and monotonic() - Db._last_write.get() < Db.sticky_seconds
+
+	@staticmethod
+	def _engine(query: Any) -> AsyncEngine:
+		"""
+		reads go to replicas unless this context wrote
+		less than `sticky_seconds` ago, everything else goes to primary
+		"""
+		if not Db.is_read(query):
+			if Db.sticky_seconds:
+				Db._last_write.set(monotonic())
+			return Db.engine
+		if not Db.replicas:
+			return Db.engine
+		if Db.is_sticky():
+			return Db.engine
+		return Db._replica()
+
+	@staticmethod
+	@asynccontextmanager
+	async def _begin(query: Any = None) -> AsyncIterator[AsyncConnection]:
+		if conn := Db._connection.get():
+			if Db.sticky_seconds and not Db.is_read(query):
+				Db._last_write.set(monotonic())
+			yield conn
+		else:
+			async with Db._engine(query).begin() as conn:
+				yield conn
+
+	#################### INSTRUMENTATION ####################
+
+	@staticmethod
+	def instrument(
+		slow_query_seconds : float | None                          = 1.0,
+		hooks              : Iterable[Callable[[QueryInfo], None]] = ()
+	) -> DbMetrics:
+		"""
+		enables query metrics and slow query log,
+		`Db.metrics = None` turns them off again
+		"""
+		Db.metrics = DbMetrics(slow_query_seconds, hooks)
+		return Db.metrics
+
+	@staticmethod
+	@contextmanager
+	def caller(model: str, method: str):
+		"""
+		attributes queries run inside the scope to model.method in metrics,
+		the outermost scope wins, set by Model methods while instrumentation is on
+		"""
+		if Db._caller.get() is not None:
+			yield
+			return
+		token = Db._caller.set((model, method))
+		try:
+			yield
+		finally:
+			Db._caller.reset(token)
+
+	@staticmethod
+	def _origin() -> tuple[str | None, str | None]:
+		return Db._caller.get() or (None, None)
+
+	@staticmethod
+	def _observe(
+		query    : Any,
+		params   : Any,
+		origin   : tuple[str | None, str | None],
+		start    : float,
+		acquired : float,
+		rows     : int
+	):
+		Db.metrics.observe(QueryInfo(
+			model           = origin[0],
+			method          = origin[1],
+			seconds         = perf_counter() - start,
+			acquire_seconds = acquired - start,
+			rows            = rows,
+			query           = query,
+			params          = params,
+			dialect         = Db.engine.dialect
+		))
+
+	@staticmethod
+	async def _run(
+		query   : Any,
+		params  : Any,
+		consume : Callable[[CursorResult], Any],
+		route   : Any                   = None,
+		rows    : Callable[[Any], int]  = len
+	) -> Any:
+		"""
+		:route statement to pick the engine by, `query` itself by default
+		:rows  number of rows in the consumed result, for metrics
+		"""
+		route = query if route is None else route
+		if Db.metrics is None:
+			async with Db._begin(route) as conn:
+				return consume(await conn.execute(query, params))
+
+		origin = Db._origin()
+		start  = perf_counter()
+		try:
+			async with Db._begin(route) as conn:
+				acquired = perf_counter()
+				result   = consume(await conn.execute(query, params))
+		except Exception:
+			Db.metrics.errors += 1
+			raise
+
+		Db._observe(query, params, origin, start, acquired, rows(result))
+		return result
+
+	@staticmethod
+	def _scalar(result: Any) -> int:
+		return 0 # no records returned
+
+	#################### QUERIES ####################
+
+	@staticmethod
+	async def fetch_one(
+		query  : Select | Insert | Update,
+		params : dict = None
+	) -> dict[str, Any] | None:
+		return await Db._run(query, params, lambda cursor: (
+			cursor.first()._asdict() if cursor.rowcount > 0 else None
+		), rows=lambda record: int(record is not None))
+
+	@staticmethod
+	async def fetch_all(
+		query  : Select | Insert | Update,
+		params : dict = None
+	) -> list[dict[str, Any]]:
+		return await Db._run(query, params, lambda cursor: [
+			r._asdict() for r in cursor.all()
+		])
+
+	@staticmethod
+	async def fetch_columns(
+		query  : Select,
+		params : dict = None
+	) -> dict[str, list]:
+		"""
+		result set as {column: values}, rows are transposed
+		from tuples without building a dict per row
+		"""
+		return await Db._run(query, params, lambda cursor: Columnar.from_rows(
+			list(cursor.keys()), cursor.all()
+		), rows=lambda columns: len(next(iter(columns.values()), ())))
+
+	@staticmethod
+	async def stream(
+		query      : Select,
+		chunk_size : int = 1000
+	) -> AsyncIterator[list[dict[str, Any]]]:
+		"""
+		yields result set in chunks of `chunk_size` rows
+		using server-side cursor, so memory stays flat
+		"""
+		metrics = Db.metrics
+		if metrics is not None:
+			origin, start, rows = Db._origin(), perf_counter(), 0
+
+		async with Db._begin(query) as conn:
+			acquired = perf_counter()
+			result   = await conn.stream(query.execution_options(yield_per=chunk_size))
+			async for partition in result.partitions(chunk_size):
+				if metrics is not None:
+					rows += len(partition)
+				yield [r._asdict() for r in partition]
+
+		if metrics is not None and Db.metrics is metrics:
+			Db._observe(query, None, origin, start, acquired, rows)
+
+	@staticmethod
+	async def fetch_exists(query: Select, params: dict = None) -> bool:
+		return await Db._run(query, params, lambda cursor: bool(cursor.scalar()), rows=Db._scalar)
+
+	@staticmethod
+	async def fetch_count(query: Select, params: dict = None) -> int:
+		"""
+		counts over the query as a subquery, so unfiltered selects keep their FROM
+		and grouped or distinct selects count result rows
+		"""
+		count_query = select(func.count()).select_from(query.order_by(None).subquery())
+		return await Db._run(count_query, params, lambda cursor: cursor.scalar() or 0, rows=Db._scalar)
+
+	@staticmethod
+	async def fetch_estimated_count(query: Select) -> int:
+		"""
+		planner row estimate of the query on PostgreSQL,
+		exact count on other dialects
+		"""
+		dialect = Db.engine.dialect
+		if dialect.name != 'postgresql':
+			return await Db.fetch_count(query)
+
+		sql = str(query.order_by(None).compile(
+			dialect        = dialect,
+			compile_kwargs = {'literal_binds': True}
+		))
+		explain = text('EXPLAIN (FORMAT JSON) ' + sql.replace(':', r'\:'))
+
+		def consume(cursor: CursorResult) -> int:
+			plan = cursor.scalar()
+			if isinstance(plan, str):
+				plan = json.loads(plan)
+			return int(plan[0]['Plan']['Plan Rows'])
+
+		return await Db._run(explain, None, consume, route=query, rows=Db._scalar)
+
+	@staticmethod
+	async def execute(query: Insert | Update, params: dict | list[dict] = None) -> None:
+		await Db._run(query, params, lambda cursor: None, rows=Db._scalar)
 
 	@staticmethod
-	def setup(url: str, **kwargs):
-		Db.engine = create_async_engine(url, **kwargs)
+	def setup(
+		url            : str,
+		replicas       : Iterable[str] = (),
+		replica_policy : str           = 'round_robin',
+		sticky_seconds : float         = 0,
+		**kwargs
+	):
+		"""
+		:replicas       read-only replica urls for SELECT queries
+		:replica_policy round_robin | least_busy (fewest checked out connections)
+		:sticky_seconds keep reads on primary for N seconds after a write in current context
+		"""
+		Db.engine         = create_async_engine(url, **kwargs)
+		Db.replicas       = [create_async_engine(r, **kwargs) for r in replicas]
+		Db.replica_policy = replica_policy
+		Db.sticky_seconds = sticky_seconds
@@ -1,6 +1,120 @@
+import json
+import re
+
+from typing   import Iterable, Union
+
 from pydantic import BaseModel
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
 class Event(BaseModel):
     name: str
     data: dict | str
     meta: dict = {}
+
+    @classmethod
+    def from_msgpack(cls, data: bytes) -> 'Event':
+        if msgpack is None:
+            raise ImportError('msgpack is required for binary frames')
+        return cls.model_validate(msgpack.unpackb(data))
+
+
+class EventPayload:
+    """
+    event serialized once and shared by every layer and connection
+    it is fanned out to, other encodings are derived from it on demand
+    """
+    __slots__ = ('text', 'event', '_data', '_binary')
+
+    _published_at = re.compile(r'"published_at":\s*([0-9.eE+-]+)')
+
+    def __init__(self, text: str, event: Event | None = None):
+        self.text    = text
+        self.event   = event # source event, spares parsing text back
+        self._data   = None
+        self._binary = None
+
+    @staticmethod
+    def of(event: Union[Event, 'EventPayload', str]) -> 'EventPayload':
+        if isinstance(event, EventPayload):
+            return event
+        if isinstance(event, str):
+            return EventPayload(event)
+        return EventPayload(event.model_dump_json(), event)
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = json.loads(self.text)
+        return self._data
+
+    @property
+    def name(self) -> str:
+        return self.event.name if self.event is not None else self.data['name']
+
+    @property
+    def meta(self) -> dict:
+        return self.event.meta if self.event is not None else self.data.get('meta') or {}
+
+    @property
+    def published_at(self) -> float | None:
+        """
+        meta.published_at stamped by RedisChannel while metrics are on,
+        found from the end of the text without parsing it, meta is serialized last
+        """
+        if self.event is not None or self._data is not None:
+            return self.meta.get('published_at')
+        start = self.text.rfind('"published_at":')
+        if start < 0:
+            return None
+        match = EventPayload._published_at.match(self.text, start)
+        try:
+            return float(match.group(1)) if match else None
+        except ValueError:
+            return None
+
+    def with_meta(self, **meta) -> 'EventPayload':
+        if self.event is not None:
+            event = self.event.model_copy(update={'meta': {**self.event.meta, **meta}})
+            return EventPayload(event.model_dump_json(), event)
+        data = {**self.data, 'meta': {**(self.data.get('meta') or {}), **meta}}
+        return EventPayload(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            if msgpack is None:
+                raise ImportError('msgpack is required for binary frames')
+            self._binary = msgpack.packb(self.data)
+        return self._binary
+
+
+class EventBatch:
+    """
+    events packed into one array frame
+    """
+    __slots__ = ('events',)
+
+    def __init__(self, events: Iterable[EventPayload]):
+        self.events = list(events)
+
+    @property
+    def text(self) -> str:
+        return '[' + ','.join(event.text for event in self.events) + ']'
+
+    @property
+    def binary(self) -> bytes:
+        if msgpack is None:
+            raise ImportError('msgpack is required for binary frames')
+        count = len(self.events) # array header + already packed events
+        if count < 16:
+            header = bytes((0x90 | count,))
+        elif count < 1 << 16:
+            header = b'\xdc' + count.to_bytes(2, 'big')
+        else:
+            header = b'\xdd' + count.to_bytes(4, 'big')
+        return header + b''.join(event.binary for event in self.events)
@@ -0,0 +1,157 @@
+import asyncio
+
+from time   import monotonic
+from typing import TYPE_CHECKING, Any, Iterable
+
+from loguru import logger
+
+from .event import Event
+
+if TYPE_CHECKING:
+	from .user_connection import UserConnection
+
+
+class TokenBucket:
+	"""
+	`rate` tokens per second, bursts of up to `capacity` tokens,
+	`rate` but at least one by default, so rates below 1 still let events through
+	"""
+	def __init__(self, rate: float, capacity: float | None = None):
+		self.rate     = rate
+		self.capacity = capacity if capacity is not None else max(rate, 1)
+		self.tokens   = self.capacity
+		self.updated  = monotonic()
+
+	def take(self, tokens: float = 1) -> bool:
+		now          = monotonic()
+		self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		if self.tokens < tokens:
+			return False
+		self.tokens -= tokens
+		return True
+
+
+class Dispatcher:
+	"""
+	runs on_event of connections concurrently instead of inline in listen():
+	up to `concurrency` handlers per connection and `limit` in total,
+	events named in `ordered` run one at a time per (user, event name),
+	a connection buffers up to `inbox_size` events and may send `rate` events
+	per second (bursts of `burst`), the rest is dropped or the connection
+	is closed depending on `overflow`
+
+	UserConnection.setup(dispatcher=Dispatcher(concurrency=4, ordered=('chat',), rate=20))
+	"""
+	THROTTLE   = 'throttle'
+	DISCONNECT = 'disconnect'
+
+	def __init__(self,
+		concurrency : int             = 4,
+		limit       : int             = 1000,
+		ordered     : Iterable[str]   = (),
+		inbox_size  : int             = 64,
+		rate        : float | None    = None,
+		burst       : float | None    = None,
+		overflow    : str             = THROTTLE
+	):
+		if overflow not in (Dispatcher.THROTTLE, Dispatcher.DISCONNECT):
+			raise ValueError(f'Unknown overflow policy: {overflow}')
+		self.concurrency = concurrency
+		self.limit       = limit
+		self.ordered     = frozenset(ordered)
+		self.inbox_size  = inbox_size
+		self.rate        = rate
+		self.burst       = burst
+		self.overflow    = overflow
+
+		self._semaphore  : asyncio.Semaphore | None = None
+		self._locks      : dict[tuple, list] = {} # (user_id, name): [lock, users]
+
+		self.handled   = 0
+		self.throttled = 0
+		self.failed    = 0
+
+	def inbox(self, connection: 'UserConnection') -> 'Inbox':
+		if self._semaphore is None:
+			self._semaphore = asyncio.Semaphore(self.limit)
+		return Inbox(self, connection)
+
+	async def _handle(self, connection: 'UserConnection', event: Event):
+		key = (connection.user_id, event.name) if event.name in self.ordered else None
+		if key is None:
+			return await self._run(connection, event)
+
+		if (entry := self._locks.get(key)) is None:
+			entry = self._locks[key] = [asyncio.Lock(), 0]
+		entry[1] += 1
+		try:
+			async with entry[0]:
+				await self._run(connection, event)
+		finally:
+			entry[1] -= 1
+			if not entry[1]:
+				del self._locks[key]
+
+	async def _run(self, connection: 'UserConnection', event: Event):
+		async with self._semaphore:
+			try:
+				await connection.on_event(connection.user_id, event)
+				self.handled += 1
+			except Exception as e:
+				self.failed += 1
+				logger.error(f'Error while handling event {event.name} of user {connection.user_id}: {e}')
+
+	def stats(self) -> dict[str, Any]:
+		return {
+			'handled'   : self.handled,
+			'throttled' : self.throttled,
+			'failed'    : self.failed,
+			'ordered'   : len(self._locks)
+		}
+
+
+class Inbox:
+	"""
+	bounded inbound queue of one connection,
+	workers are started on demand and exit once it is drained
+	"""
+	def __init__(self, dispatcher: Dispatcher, connection: 'UserConnection'):
+		self.dispatcher = dispatcher
+		self.connection = connection
+		self.queue      = asyncio.Queue(dispatcher.inbox_size)
+		self.bucket     = TokenBucket(dispatcher.rate, dispatcher.burst) if dispatcher.rate else None
+		self.workers    : set[asyncio.Task] = set()
+
+	def put(self, event: Event) -> bool:
+		"""
+		returns False when the event is over the rate limit or the inbox is full
+		"""
+		if self.bucket is not None and not self.bucket.take():
+			self.dispatcher.throttled += 1
+			return False
+		try:
+			self.queue.put_nowait(event)
+		except asyncio.QueueFull:
+			self.dispatcher.throttled += 1
+			return False
+
+		if len(self.workers) < self.dispatcher.concurrency:
+			worker = asyncio.create_task(self._work())
+			self.workers.add(worker)
+			worker.add_done_callback(self.workers.discard)
+		return True
+
+	async def _work(self):
+		try:
+			while not self.queue.empty():
+				await self.dispatcher._handle(self.connection, self.queue.get_nowait())
+		finally:
+			self.workers.discard(asyncio.current_task()) # right away, put() may start the next one meanwhile
+
+	def close(self):
+		"""
+		drops events not started yet, running handlers complete
+		"""
+		while not self.queue.empty():
+			self.queue.get_nowait()
@@ -0,0 +1,86 @@
+import asyncio
+
+from contextvars import Context
+from typing      import Any, Awaitable, Callable, Hashable
+
+
+class BatchLoader:
+	"""
+	collects keys requested within one loop tick (or `window` seconds),
+	loads them with a single call and resolves every awaiter,
+	identical keys share one future, shielded per caller,
+	so a cancelled caller does not cancel the others
+
+	loader = BatchLoader(load_users_by_ids)
+	user   = await loader.load(user_id)
+	"""
+	def __init__(self,
+		load     : Callable[[list], Awaitable[dict[Hashable, Any]]],
+		window   : float = 0,
+		max_size : int   = 500
+	):
+		self._load     = load
+		self.window    = window
+		self.max_size  = max_size
+		self._pending  : dict[Hashable, asyncio.Future] = {}
+		self._handle   : asyncio.Handle | None = None
+		self._loop     : asyncio.AbstractEventLoop | None = None
+		self._tasks    : set[asyncio.Task] = set()
+
+		self.batches = 0
+		self.keys    = 0
+		self.hits    = 0 # keys de-duplicated within a batch
+
+	def load(self, key: Hashable) -> asyncio.Future:
+		if future := self._pending.get(key):
+			self.hits += 1
+			return asyncio.shield(future)
+
+		loop = asyncio.get_running_loop()
+		if loop is not self._loop: # loader outlived previous loop
+			self._loop, self._pending, self._handle = loop, {}, None
+
+		future = loop.create_future()
+		self._pending[key] = future
+
+		if len(self._pending) >= self.max_size:
+			self._dispatch()
+		elif self._handle is None:
+			# empty context: the batch must not inherit caller's Db.session()
+			if self.window:
+				self._handle = loop.call_later(self.window, self._dispatch, context=Context())
+			else:
+				self._handle = loop.call_soon(self._dispatch, context=Context())
+		return asyncio.shield(future)
+
+	def _dispatch(self):
+		if self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+		pending, self._pending = self._pending, {}
+		if pending:
+			task = Context().run(asyncio.ensure_future, self._resolve(pending))
+			self._tasks.add(task)
+			task.add_done_callback(self._tasks.discard)
+
+	async def _resolve(self, pending: dict[Hashable, asyncio.Future]):
+		self.batches += 1
+		self.keys    += len(pending)
+		try:
+			results = await self._load(list(pending))
+		except Exception as e:
+			for future in pending.values():
+				if not future.done():
+					future.set_exception(e)
+			return
+		for key, future in pending.items():
+			if not future.done():
+				future.set_result(results.get(key))
+
+	def stats(self) -> dict[str, Any]:
+		return {
+			'batches'    : self.batches,
+			'keys'       : self.keys,
+			'hits'       : self.hits,
+			'batch_size' : self.keys / self.batches if self.batches else 0.0
+		}
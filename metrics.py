@@ -0,0 +1,257 @@
+from bisect      import bisect_left
+from collections import deque
+from dataclasses import dataclass, field
+from time        import monotonic, time
+from typing      import Any, Callable, Iterable
+
+from loguru      import logger
+
+
+class Histogram:
+	BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+	def __init__(self, buckets: Iterable[float] = BUCKETS):
+		self.buckets = tuple(buckets)
+		self.counts  = [0] * (len(self.buckets) + 1) # last one is +Inf
+		self.sum     = 0.0
+		self.count   = 0
+
+	def observe(self, value: float):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum   += value
+		self.count += 1
+
+	def cumulative(self) -> list[tuple[str, int]]:
+		result, total = [], 0
+		for le, count in zip((*self.buckets, '+Inf'), self.counts):
+			total += count
+			result.append((str(le), total))
+		return result
+
+	def snapshot(self) -> dict[str, Any]:
+		return {
+			'count'   : self.count,
+			'sum'     : self.sum,
+			'buckets' : dict(self.cumulative())
+		}
+
+	def to_prometheus(self, name: str, labels: dict[str, str] = None) -> list[str]:
+		labels = labels or {}
+		lines  = [
+			f'{name}_bucket{Prometheus.labels({**labels, "le": le})} {count}'
+			for le, count in self.cumulative()
+		]
+		lines.append(f'{name}_sum{Prometheus.labels(labels)} {self.sum}')
+		lines.append(f'{name}_count{Prometheus.labels(labels)} {self.count}')
+		return lines
+
+
+class Prometheus:
+	@staticmethod
+	def escape(value: Any) -> str:
+		return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+	@staticmethod
+	def labels(labels: dict[str, Any]) -> str:
+		if not labels:
+			return ''
+		return '{' + ','.join(
+			f'{k}="{Prometheus.escape(v)}"' for k, v in labels.items()
+		) + '}'
+
+	@staticmethod
+	def render(metrics: dict[str, tuple[str, list[str]]]) -> str:
+		"""
+		metrics: {name: (type, lines)}
+		"""
+		out = []
+		for name, (_type, lines) in metrics.items():
+			out.append(f'# TYPE {name} {_type}')
+			out += lines
+		return '\n'.join(out) + '\n'
+
+
+#################### DATABASE ####################
+
+@dataclass
+class QueryInfo:
+	model           : str | None
+	method          : str | None
+	seconds         : float
+	acquire_seconds : float
+	rows            : int
+	query           : Any
+	params          : Any
+	dialect         : Any = field(repr=False, default=None)
+
+	@property
+	def sql(self) -> str:
+		return str(self.query.compile(dialect=self.dialect))
+
+
+class DbMetrics:
+	"""
+	per (Model, method) query timings, pool acquire times,
+	rows returned and slow query log, see Db.instrument(),
+	scalar queries (exists, counts) and writes return no rows
+	"""
+	def __init__(self,
+		slow_query_seconds : float | None                          = 1.0,
+		hooks              : Iterable[Callable[[QueryInfo], None]] = ()
+	):
+		self.slow_query_seconds = slow_query_seconds
+		self.hooks              = list(hooks)
+
+		self.durations : dict[tuple, Histogram] = {}
+		self.rows      : dict[tuple, int]       = {}
+		self.acquire   = Histogram()
+		self.slow      = 0
+		self.errors    = 0
+
+	def observe(self, info: QueryInfo):
+		key = (info.model, info.method)
+		if (histogram := self.durations.get(key)) is None:
+			histogram = self.durations[key] = Histogram()
+			self.rows[key] = 0
+		histogram.observe(info.seconds)
+		self.rows[key] += info.rows
+		self.acquire.observe(info.acquire_seconds)
+
+		if self.slow_query_seconds is not None and info.seconds >= self.slow_query_seconds:
+			self.slow += 1
+			logger.warning(
+				f'Slow query {info.seconds:.3f}s in {info.model}.{info.method}: '
+				f'{info.sql} {info.params or ""}'
+			)
+
+		for hook in self.hooks:
+			try:
+				hook(info)
+			except Exception as e:
+				logger.error(f'Query hook error: {e}')
+
+	def snapshot(self) -> dict[str, Any]:
+		return {
+			'queries': [
+				{
+					'model'  : model,
+					'method' : method,
+					'rows'   : self.rows[(model, method)],
+					**histogram.snapshot()
+				}
+				for (model, method), histogram in self.durations.items()
+			],
+			'acquire' : self.acquire.snapshot(),
+			'slow'    : self.slow,
+			'errors'  : self.errors
+		}
+
+	def to_prometheus(self, prefix: str = 'puerpy_db') -> str:
+		durations, rows = [], []
+		for (model, method), histogram in self.durations.items():
+			labels = {'model': model or '', 'method': method or ''}
+			durations += histogram.to_prometheus(f'{prefix}_query_seconds', labels)
+			rows.append(f'{prefix}_query_rows_total{Prometheus.labels(labels)} {self.rows[(model, method)]}')
+
+		return Prometheus.render({
+			f'{prefix}_query_seconds'        : ('histogram', durations),
+			f'{prefix}_query_rows_total'     : ('counter',   rows),
+			f'{prefix}_pool_acquire_seconds' : ('histogram', self.acquire.to_prometheus(f'{prefix}_pool_acquire_seconds')),
+			f'{prefix}_slow_queries_total'   : ('counter',   [f'{prefix}_slow_queries_total {self.slow}']),
+			f'{prefix}_query_errors_total'   : ('counter',   [f'{prefix}_query_errors_total {self.errors}'])
+		})
+
+
+#################### REALTIME ####################
+
+class RealtimeMetrics:
+	"""
+	websocket and redis channel counters, publish-to-socket latency,
+	outbound queue sizes per connection and gauges read on snapshot,
+	see UserConnectionPool.instrument()
+
+	message rates are averaged over the last `rate_window` seconds
+	or more, the same for every reader
+	"""
+	BACKLOG_BUCKETS = (0, 1, 4, 16, 64, 256, 1024)
+
+	def __init__(self, latency_buckets: Iterable[float] = Histogram.BUCKETS, rate_window: float = 10):
+		self.gauges      : dict[str, Callable[[], float]]      = {}   # name: read current value
+		self.backlogs    : Callable[[], dict[str, int]] | None = None # read queued events by connection id
+		self.latency     = Histogram(latency_buckets)
+		self.rate_window = rate_window
+
+		self.messages_in   = 0
+		self.messages_out  = 0
+		self.redis_in      = 0
+		self.send_failures = 0
+		self.dropped       = 0
+
+		self._samples : deque[tuple[float, int, int]] = deque([(monotonic(), 0, 0)]) # time, messages_in, messages_out
+
+	def gauge(self, name: str, read: Callable[[], float]):
+		self.gauges[name] = read
+
+	def _rates(self) -> tuple[float, float]:
+		"""
+		samples are taken at most once a second, kept for `rate_window`
+		"""
+		now     = monotonic()
+		samples = self._samples
+		if now - samples[-1][0] >= 1:
+			samples.append((now, self.messages_in, self.messages_out))
+		while len(samples) > 1 and now - samples[1][0] >= self.rate_window:
+			samples.popleft()
+
+		then, messages_in, messages_out = samples[0]
+		elapsed = now - then
+		if not elapsed:
+			return 0.0, 0.0
+		return (self.messages_in - messages_in) / elapsed, (self.messages_out - messages_out) / elapsed
+
+	def sent(self, published_at: float | None, count: int = 1):
+		self.messages_out += count
+		if published_at is not None:
+			self.latency.observe(max(time() - published_at, 0))
+
+	def snapshot(self) -> dict[str, Any]:
+		"""
+		backlogs lists connections with queued events only
+		"""
+		backlogs = self.backlogs() if self.backlogs else {}
+		in_per_sec, out_per_sec = self._rates()
+		return {
+			**{name: read() for name, read in self.gauges.items()},
+			'backlog'              : sum(backlogs.values()),
+			'max_backlog'          : max(backlogs.values(), default=0),
+			'backlogs'             : {connection_id: size for connection_id, size in backlogs.items() if size},
+			'messages_in'          : self.messages_in,
+			'messages_out'         : self.messages_out,
+			'messages_in_per_sec'  : in_per_sec,
+			'messages_out_per_sec' : out_per_sec,
+			'redis_in'             : self.redis_in,
+			'send_failures'        : self.send_failures,
+			'dropped'              : self.dropped,
+			'latency'              : self.latency.snapshot()
+		}
+
+	def to_prometheus(self, prefix: str = 'puerpy_realtime') -> str:
+		metrics = {
+			f'{prefix}_{name}': ('gauge', [f'{prefix}_{name} {read()}'])
+			for name, read in self.gauges.items()
+		}
+		for name in ('messages_in', 'messages_out', 'redis_in', 'send_failures', 'dropped'):
+			metrics[f'{prefix}_{name}_total'] = ('counter', [f'{prefix}_{name}_total {getattr(self, name)}'])
+
+		sizes   = list(self.backlogs().values()) if self.backlogs else []
+		backlog = Histogram(RealtimeMetrics.BACKLOG_BUCKETS) # per connection, without a label per connection
+		for size in sizes:
+			backlog.observe(size)
+		metrics[f'{prefix}_backlog']     = ('gauge', [f'{prefix}_backlog {sum(sizes)}'])
+		metrics[f'{prefix}_max_backlog'] = ('gauge', [f'{prefix}_max_backlog {max(sizes, default=0)}'])
+		metrics[f'{prefix}_connection_backlog'] = ('histogram', backlog.to_prometheus(f'{prefix}_connection_backlog'))
+		metrics[f'{prefix}_publish_latency_seconds'] = (
+			'histogram',
+			self.latency.to_prometheus(f'{prefix}_publish_latency_seconds')
+		)
+		return Prometheus.render(metrics)
@@ -1,4 +1,9 @@
-from typing     import Any, Iterable, Callable
+import base64
+import inspect
+import json
+
+from functools  import wraps
+from typing     import TYPE_CHECKING, Any, AsyncIterator, Iterable, Callable
 
 from sqlalchemy import (
 	Table,
@@ -8,22 +13,114 @@ from sqlalchemy import (
 	exists,
 	delete,
 	and_,
+	tuple_,
+	bindparam,
+	func,
+
+	ColumnElement,
+	Executable,
 
 	Select,
 	Insert,
 	Update
 )
-from sqlalchemy.orm import aliased
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm      import aliased
+
+from .cache        import RecordCache, ResultCache, StatementCache
+from .codec        import Codec
+from .columnar     import Columnar
+from .db           import Db
+from .loader       import BatchLoader
+from .write_behind import WriteBehind
+
+if TYPE_CHECKING:
+	from pydantic import TypeAdapter
+
+
+def _traced(f: Callable) -> Callable:
+	"""
+	attributes queries of a Model method to (Model, method) in Db metrics,
+	costs one check while Db.instrument() is off
+	"""
+	name = f.__name__
+
+	if inspect.isasyncgenfunction(f):
+		async def steps(cls, *args, **kwargs):
+			iterator = f(cls, *args, **kwargs)
+			try:
+				while True:
+					with Db.caller(cls.__name__, name): # set per step, steps may run in other contexts
+						try:
+							item = await iterator.__anext__()
+						except StopAsyncIteration:
+							return
+					yield item
+			finally:
+				await iterator.aclose()
+
+		@wraps(f)
+		def generator(cls, *args, **kwargs):
+			if Db.metrics is None:
+				return f(cls, *args, **kwargs)
+			return steps(cls, *args, **kwargs)
+		return generator
+
+	@wraps(f)
+	async def method(cls, *args, **kwargs):
+		if Db.metrics is None:
+			return await f(cls, *args, **kwargs)
+		with Db.caller(cls.__name__, name):
+			return await f(cls, *args, **kwargs)
+	return method
+
+
+class Record(dict):
+	"""
+	record of a Model with lazy fields,
+	calculated on first `record[name]` or `record.get(name)`
+	"""
+	__slots__ = ('_model',)
+
+	def __init__(self, model: type['Model'], data: dict):
+		super().__init__(data)
+		self._model = model
 
-from .db import Db
+	def __missing__(self, key: str) -> Any:
+		if key not in self._model._lazy_decorators:
+			raise KeyError(key)
+		value = self[key] = self._model._compute_lazy(key, self)
+		return value
+
+	def get(self, key: str, default: Any = None) -> Any:
+		if key in self or key not in self._model._lazy_decorators:
+			return super().get(key, default)
+		return self[key]
+
+	def copy(self) -> 'Record':
+		return Record(self._model, self)
+
+	def __reduce__(self):
+		return Record, (self._model, dict(self))
 
 
 class Model:
-	__aliases_cache    : dict = None
-	__decorators_cache : dict[str, Callable] = None
+	_aliases           : dict                     = None
+	_decorators        : dict[str, Callable]      = {}
+	_batch_decorators  : dict[str, Callable]      = {}
+	_lazy_decorators   : dict[str, tuple]         = {}
+	_decorator_columns : dict[str, None]          = {}
+	_loaders           : dict[tuple, BatchLoader] = {}
 
 	__pk_field__         = 'id'
 	__time_order_field__ = 'created'
+	__unique_fields__    = ()
+	__record_cache__     : RecordCache = None
+	__result_cache__     : ResultCache = None
+	__write_behind__     : WriteBehind = None
+	__batch_window__     : float       = None # seconds, 0 - one loop tick, None - disabled
+	__batch_size__       = 500
+	__bind_limit__       = 32_766 # bound values per statement, asyncpg and sqlite cap them
 	__related__          = {}
 	"""
 	:__related__
@@ -40,31 +137,127 @@ class Model:
 
 	#################### POST PROCESSING ####################
 
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls._aliases = None
+		cls._resolve_decorators()
+		if (buffer := cls.__dict__.get('__write_behind__')) is not None:
+			buffer.flusher = cls._flush_updates
+			buffer.name    = cls.__name__
+
+	@classmethod
+	def _resolve_decorators(cls):
+		"""
+		define_<name>(record)        - computed per record
+		define_many_<name>(records)  - computed once per result set,
+		                               returns values in order of records
+		@Model.lazy                  - computed on first access or by Model.compute()
+		"""
+		cls._decorators        = {}
+		cls._batch_decorators  = {}
+		cls._lazy_decorators   = {}
+		cls._decorator_columns = {}
+
+		for klass in reversed(cls.__mro__):
+			if not issubclass(klass, Model):
+				continue
+			for name in klass.__dict__:
+				if not name.startswith('define_'):
+					continue
+				f = getattr(cls, name)
+				if not callable(f):
+					continue
+
+				is_batch = name.startswith('define_many_')
+				field    = name[12:] if is_batch else name[7:]
+				for decorators in (cls._decorators, cls._batch_decorators, cls._lazy_decorators):
+					decorators.pop(field, None)
+
+				if getattr(f, '__lazy__', False):
+					cls._lazy_decorators[field] = (f, is_batch)
+				elif is_batch:
+					cls._batch_decorators[field] = f
+				else:
+					cls._decorators[field] = f
+				cls._decorator_columns.update(dict.fromkeys(getattr(f, '__columns__', ())))
+
 	@classmethod
 	def _get_decorators(cls) -> dict[str, Callable]:
-		if cls.__decorators_cache is None:
-			cls.__decorators_cache = {}
-			for name in cls.__dict__:
-				if name.startswith('define_'):
-					f = getattr(cls, name)
-					if callable(f):
-						cls.__decorators_cache[name[7:]] = f
-		return cls.__decorators_cache
+		return cls._decorators
+
+	@staticmethod
+	def depends_on(*columns: str) -> Callable:
+		"""
+		declares columns a define_* decorator reads,
+		they are always selected when a projection is requested
+
+		@Model.depends_on('first_name', 'last_name')
+		def define_full_name(record):
+			return f'{record["first_name"]} {record["last_name"]}'
+		"""
+		def wrapper(f: Callable) -> Callable:
+			getattr(f, '__func__', f).__columns__ = columns
+			return f
+		return wrapper
+
+	@staticmethod
+	def lazy(f: Callable) -> Callable:
+		"""
+		marks define_* decorator as lazy
+
+		@Model.lazy
+		def define_avatar_url(record):
+			...
+		"""
+		getattr(f, '__func__', f).__lazy__ = True
+		return f
+
+	@classmethod
+	def _projection(cls, columns: Iterable[str]) -> tuple[str, ...]:
+		projection = dict.fromkeys(columns)
+		projection.update(cls._decorator_columns)
+		return tuple(projection)
+
+	@classmethod
+	def _compute_lazy(cls, name: str, record: dict) -> Any:
+		f, is_batch = cls._lazy_decorators[name]
+		return next(iter(f([record]))) if is_batch else f(record)
+
+	@classmethod
+	def compute(cls, records: list[dict], *names: str) -> list[dict]:
+		"""
+		explicitly computes lazy fields of records,
+		batch decorators are called once for all records
+		"""
+		for name in names:
+			f, is_batch = cls._lazy_decorators[name]
+			if is_batch:
+				for record, value in zip(records, f(records)):
+					record[name] = value
+			else:
+				for record in records:
+					record[name] = f(record)
+		return records
 
 	@classmethod
 	def _decorate_record(cls, record: dict | None) -> dict | None:
 		if not isinstance(record, dict) or record is None:
 			return record
-		for name, f in cls._get_decorators().items():
-			record[name] = f(record)
-		return record
+		return cls._decorate_records([record])[0]
 
 	@classmethod
 	def _decorate_records(cls, records: list) -> list:
-		return [
-			cls._decorate_record(r)
-			for r in records
-		]
+		if not records:
+			return records
+		if cls._lazy_decorators:
+			records = [Record(cls, r) for r in records]
+		for name, f in cls._decorators.items():
+			for record in records:
+				record[name] = f(record)
+		for name, f in cls._batch_decorators.items():
+			for record, value in zip(records, f(records)):
+				record[name] = value
+		return records
 
 	@staticmethod
 	def normalize_joined(sub_models: Iterable[str], data: dict) -> dict:
@@ -72,7 +265,7 @@ class Model:
 		prepare data from puerpy.model.Model.get_by_join()
 		for BaseModel.model_validate method
 		"""
-		normalized = {}
+		normalized = Record(data._model, {}) if isinstance(data, Record) else {}
 
 		for key, value in data.items():
 			splitted_key = key.split('__')
@@ -88,23 +281,248 @@ class Model:
 		return normalized
 
 	@staticmethod
-	def normalize_joined_list(sub_models: Iterable[str], data: Iterable[dict]) -> list[dict]:
+	def normalize_plan(sub_models: Iterable[str], keys: Iterable[str]) -> list[tuple[str, list | None]]:
+		"""
+		maps result set keys to (key, None) for own columns
+		and to (sub_model, [(field, key), ...]) for joined ones,
+		keeps position of the first key of each sub model
+		"""
+		sub_models = set(sub_models)
+		plan       = []
+		fields     = {}
+		for key in keys:
+			sub_model, sep, field = key.partition('__')
+			if sep and sub_model in sub_models:
+				if sub_model not in fields:
+					fields[sub_model] = []
+					plan.append((sub_model, fields[sub_model]))
+				fields[sub_model].append((field, key))
+			else:
+				plan.append((key, None))
+		return plan
+
+	@staticmethod
+	def normalize_joined_list(
+		sub_models : Iterable[str],
+		data       : Iterable[dict],
+		adapter    : 'TypeAdapter' = None
+	) -> list[dict] | Any:
 		"""
 		prepare data from puerpy.model.Model.get_all_join()
-		for RootModel[list[BaseModel]].model_validate method
+		for RootModel[list[BaseModel]].model_validate method,
+		or validates it right away with `adapter`, e.g. TypeAdapter(list[UserOut])
+
+		all rows of a result set share keys, so they are
+		mapped to sub models once per call instead of once per row
 		"""
-		return [Model.normalize_joined(sub_models, d) for d in data]
+		data       = data if isinstance(data, list) else list(data)
+		normalized = []
+		if data:
+			plan = Model.normalize_plan(sub_models, data[0].keys())
+			for row in data:
+				record = Record(row._model, {}) if isinstance(row, Record) else {}
+				for key, fields in plan:
+					if fields is None:
+						record[key] = row[key]
+					else:
+						record[key] = {field: row[k] for field, k in fields}
+				normalized.append(record)
+		return adapter.validate_python(normalized) if adapter else normalized
+
+	#################### RECORD CACHE ####################
+
+	@classmethod
+	def _record_cache(cls, field: str = None) -> RecordCache | None:
+		"""
+		opt-in cache, returns None when disabled
+		or when `field` is neither pk nor unique
+		"""
+		cache = cls.__record_cache__
+		if cache is None:
+			return None
+		if cache.name is None:
+			cache.bind(
+				cls.__name__,
+				cls.__pk_field__,
+				cls.__unique_fields__,
+				lambda data: Record(cls, data) if cls._lazy_decorators else data
+			)
+		if field is None or cache.is_key(field):
+			return cache
+		return None
+
+	@classmethod
+	async def _cache_record(cls, record: dict | None, generation: int = None):
+		"""
+		inside Db.session() the transaction may still roll back,
+		so the entry is dropped after commit instead of being refreshed,
+		:generation of the cache a read started at, see RecordCache.put()
+		"""
+		if record and (cache := cls._record_cache()):
+			if Db.in_session():
+				await cls._invalidate_record(record[cls.__pk_field__])
+			else:
+				await cache.put(record, generation)
+
+	@classmethod
+	async def _invalidate_record(cls, pk: Any):
+		"""
+		inside Db.session() the entry is dropped once the transaction commits,
+		dropped earlier it would be cached again by a concurrent read
+		of the row as it was before the transaction
+		"""
+		if cache := cls._record_cache():
+			await Db.after_commit(lambda: cache.invalidate(pk))
+
+	#################### RESULT CACHE ####################
+
+	@classmethod
+	def _result_cache(cls, query: Any) -> ResultCache | None:
+		"""
+		opt-in cache of read queries, bypassed inside Db.session()
+		where reads may see not yet committed data
+		"""
+		cache = cls.__result_cache__
+		if cache is None or Db.in_session() or not Db.is_read(query):
+			return None
+		return cache
+
+	@staticmethod
+	async def _invalidate_results(query: Any):
+		"""
+		inside Db.session() tables are dropped once it commits, otherwise
+		reads in between would cache rows as they were before the transaction
+		"""
+		if ResultCache._instances and not Db.is_read(query):
+			tables = ResultCache.tables(query)
+
+			async def invalidate():
+				ResultCache.invalidate_tables(tables)
+
+			await Db.after_commit(invalidate)
+
+	#################### BATCHING ####################
+
+	@classmethod
+	def _loader(cls, field: str) -> BatchLoader | None:
+		"""
+		batches concurrent get_by/exists calls for the same field
+		into one `WHERE field IN (...)` query, disabled inside Db.session()
+		to keep transactional reads on the session connection
+		and after a recent write to keep reads on primary (see Db.sticky_seconds),
+		the batch runs in a context of its own
+		"""
+		if cls.__batch_window__ is None or Db.in_session() or (Db.replicas and Db.is_sticky()):
+			return None
+		loader = Model._loaders.get((cls, field))
+		if loader is None:
+			loader = Model._loaders[(cls, field)] = BatchLoader(
+				lambda values: cls._load_many(field, values),
+				cls.__batch_window__,
+				cls.__batch_size__
+			)
+		return loader
+
+	@classmethod
+	@_traced
+	async def _load_many(cls, field: str, values: list) -> dict[Any, dict]:
+		"""
+		rows are matched to requested values in python, a row the database
+		matched differently (str for uuid, case-insensitive collation, coerced types)
+		is matched by converting its value to the requested type, failing that
+		the values left are looked up one by one
+		"""
+		records = await cls.fetch_all(
+			cls.statement('load_many', (field,), lambda: (
+				select(cls)
+					.where(getattr(cls, field).in_(bindparam('_values', expanding=True)))
+			)),
+			{'_values': values}
+		)
+		wanted    = set(values)
+		types     = {type(v) for v in values}
+		loaded    = {}
+		unmatched = False
+		for record in records:
+			key = record[field]
+			if key not in wanted:
+				for _type in types:
+					try:
+						converted = _type(key)
+					except Exception:
+						continue
+					if converted in wanted:
+						key = converted
+						break
+				else:
+					unmatched = True
+					continue
+			loaded.setdefault(key, record)
+
+		if unmatched:
+			for value in wanted - loaded.keys():
+				if record := await cls.fetch_one(cls._q_get_by(field), {'_value': value}):
+					loaded[value] = record
+		return loaded
+
+	#################### KEYSET CURSOR ####################
+
+	@staticmethod
+	def encode_cursor(values: Iterable, order: Iterable = ()) -> str:
+		"""
+		packs keyset values and the ordering they were taken in
+		into opaque url-safe token
+		"""
+		token = {'o': list(order), 'v': [Codec.dump(value) for value in values]}
+		return base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+
+	@staticmethod
+	def decode_cursor(cursor: str, order: Iterable = (), size: int = None) -> tuple:
+		"""
+		:order ordering the cursor has to be issued for
+		:size  number of values the cursor has to hold
+		raises ValueError for malformed or foreign tokens
+		"""
+		try:
+			token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+			if not isinstance(token, dict) or token.get('o') != list(order):
+				raise ValueError('ordering mismatch')
+			packed = token.get('v')
+			if not isinstance(packed, list) or (size is not None and len(packed) != size):
+				raise ValueError('arity mismatch')
+			return tuple(Model._decode_cursor_value(value) for value in packed)
+		except (ValueError, TypeError, KeyError, AttributeError, ArithmeticError) as e:
+			raise ValueError(f'Invalid cursor: {cursor}') from e
+
+	@staticmethod
+	def _decode_cursor_value(value: Any) -> Any:
+		value = Codec.load(value)
+		if isinstance(value, (dict, list)):
+			raise ValueError('malformed value')
+		return value
 
 	#################### QUERY BUILDING ####################
 
 	@classmethod
 	def aliases(cls) -> dict:
-		if not cls.__aliases_cache:
-			cls.__aliases_cache = {
+		if not cls._aliases:
+			cls._aliases = {
 				name: aliased(Table(cls.__related__[name]['table'], cls.metadata))
 				for name in cls.__related__
 			}
-		return cls.__aliases_cache
+		return cls._aliases
+
+	@classmethod
+	def statement(cls,
+		operation : str,
+		fields    : tuple,
+		build     : Callable[[], Executable]
+	) -> Executable:
+		"""
+		pre-built statement cached per (Model subclass, operation, fields),
+		values have to be passed as bind parameters
+		"""
+		return StatementCache.get((cls, operation, fields), build)
 
 	@classmethod
 	def q_filter(cls, q: Select, filters: Iterable = None) -> Select:
@@ -113,19 +531,58 @@ class Model:
 		return q
 
 	@classmethod
-	def q_join(cls, tables: Iterable[str], filters: Iterable = None) -> Select:
+	def q_select(cls, columns: Iterable[str] = None) -> Select:
+		"""
+		select of the whole model or of `columns` only
+		(plus columns declared by define_* decorators)
+		"""
+		if columns is None:
+			return select(cls)
+		columns = tuple(columns)
+		return cls.statement('select', columns, lambda: select(
+			*[getattr(cls, c) for c in cls._projection(columns)]
+		))
+
+	@classmethod
+	def q_join(cls,
+		tables          : Iterable[str],
+		filters         : Iterable                 = None,
+		columns         : Iterable[str]            = None,
+		related_columns : dict[str, Iterable[str]] = None
+	) -> Select:
+		"""
+		:columns         model columns to select, all by default
+		:related_columns {table: columns} to select from joined tables, all by default
+		"""
+		tables  = tuple(tables)
+		columns = tuple(columns) if columns is not None else None
+		related = tuple(
+			(t, tuple(c)) for t, c in (related_columns or {}).items()
+		)
+		return cls.q_filter(
+			cls.statement('q_join', (tables, columns, related), lambda: cls._q_join(
+				tables, columns, dict(related)
+			)),
+			filters
+		)
+
+	@classmethod
+	def _q_join(cls,
+		tables          : tuple[str, ...],
+		columns         : tuple[str, ...] | None,
+		related_columns : dict[str, tuple[str, ...]]
+	) -> Select:
 		aliases = cls.aliases()
 		labels = [
-			getattr(aliases[t].c, c.key).label(f'{t}__{c.key}')
+			getattr(aliases[t].c, c).label(f'{t}__{c}')
 			for t in tables
-			for c in aliases[t].c
+			for c in related_columns.get(t) or [c.key for c in aliases[t].c]
 		]
 
-		q = cls.q_filter(
-			select(cls, *labels)
-				.select_from(cls),
-			filters
-		)
+		q = select(
+			*(cls.q_select(columns).selected_columns if columns is not None else [cls]),
+			*labels
+		).select_from(cls)
 
 		for t in tables:
 			on = cls.__related__[t]['on']
@@ -138,96 +595,462 @@ class Model:
 	#################### DB OPERATIONS ####################
 
 	@classmethod
+	@_traced
 	async def fetch_one(cls,
-		query : Select | Insert | Update,
+		query  : Select | Insert | Update,
+		params : dict = None
 	) -> dict[str, Any] | None:
 		"""Can be extended in child classes"""
-		return cls._decorate_record(
-			await Db.fetch_one(query)
-		)
+		async def load() -> dict | None:
+			return cls._decorate_record(await Db.fetch_one(query, params))
+
+		if cache := cls._result_cache(query):
+			record = await cache.fetch(query, params, Db.engine.dialect, load)
+			return record.copy() if record else record
+
+		record = await load()
+		await cls._invalidate_results(query)
+		return record
 
 	@classmethod
+	@_traced
 	async def fetch_all(cls,
-		query: Select | Insert | Update
+		query  : Select | Insert | Update,
+		params : dict = None
 	) -> list[dict[str, Any]]:
 		"""Can be extended in child classes"""
-		return cls._decorate_records(
-			await Db.fetch_all(query)
-		)
+		async def load() -> list[dict]:
+			return cls._decorate_records(await Db.fetch_all(query, params))
+
+		if cache := cls._result_cache(query):
+			records = await cache.fetch(query, params, Db.engine.dialect, load)
+			return [r.copy() for r in records]
+
+		records = await load()
+		await cls._invalidate_results(query)
+		return records
+
+	@classmethod
+	@_traced
+	async def stream(cls,
+		query      : Select,
+		chunk_size : int = 1000
+	) -> AsyncIterator[list[dict[str, Any]]]:
+		"""Can be extended in child classes"""
+		async for records in Db.stream(query, chunk_size):
+			yield cls._decorate_records(records)
+
+	@classmethod
+	@_traced
+	async def fetch_columns(cls,
+		query  : Select,
+		params : dict = None,
+		output : str  = 'numpy'
+	) -> dict[str, Any] | Any:
+		"""
+		columnar result for analytics, define_* decorators are not applied
+		:output list | numpy | arrow
+		"""
+		columns = await Db.fetch_columns(query, params)
+		if output == 'numpy':
+			return Columnar.to_numpy(columns)
+		if output == 'arrow':
+			return Columnar.to_arrow(columns)
+		return columns
 
 	@classmethod
-	async def fetch_exists(cls, query: Select) -> bool:
+	@_traced
+	async def fetch_exists(cls, query: Select, params: dict = None) -> bool:
 		"""Can be extended in child classes"""
-		return await Db.fetch_exists(query)
+		return await Db.fetch_exists(query, params)
 
 	@classmethod
-	async def fetch_count(cls, query: Select) -> int:
+	@_traced
+	async def fetch_count(cls, query: Select, params: dict = None) -> int:
 		"""Can be extended in child classes"""
-		return await Db.fetch_count(query)
+		return await Db.fetch_count(query, params)
 
 	@classmethod
-	async def execute(cls, query: Insert | Update) -> None:
+	@_traced
+	async def fetch_estimated_count(cls, query: Select) -> int:
 		"""Can be extended in child classes"""
-		return await Db.execute(query)
+		return await Db.fetch_estimated_count(query)
+
+	@classmethod
+	@_traced
+	async def execute(cls, query: Insert | Update, params: dict | list[dict] = None) -> None:
+		"""Can be extended in child classes"""
+		await Db.execute(query, params)
+		await cls._invalidate_results(query)
 
 	#################### SQL OPERATIONS ####################
 
 	@classmethod
+	@_traced
 	async def create(cls, data: dict) -> dict:
-		return cls._decorate_record(await Db.fetch_one(
-			insert(cls)
-				.values(**data)
-				.returning(cls)
-		))
+		q      = insert(cls).values(**data).returning(cls)
+		record = cls._decorate_record(await Db.fetch_one(q))
+		await cls._invalidate_results(q)
+		await cls._cache_record(record)
+		return record
+
+	@classmethod
+	def _chunks(cls, rows: Iterable[dict], chunk_size: int) -> Iterable[list[dict]]:
+		"""
+		chunks of at most `chunk_size` rows and __bind_limit__ bound values
+		"""
+		chunk, size = [], chunk_size
+		for row in rows:
+			if not chunk:
+				size = max(1, min(chunk_size, cls.__bind_limit__ // max(len(row), 1)))
+			chunk.append(row)
+			if len(chunk) >= size:
+				yield chunk
+				chunk = []
+		if chunk:
+			yield chunk
+
+	@classmethod
+	@_traced
+	async def create_many(cls,
+		rows       : Iterable[dict],
+		chunk_size : int = 1000
+	) -> list[dict]:
+		"""
+		multi-row insert, one statement and transaction per chunk
+		"""
+		records = []
+		for chunk in cls._chunks(rows, chunk_size):
+			records += await cls.fetch_all(
+				insert(cls)
+					.values(chunk)
+					.returning(cls)
+			)
+		for record in records:
+			await cls._cache_record(record)
+		return records
 
 	@classmethod
+	@_traced
+	async def upsert_many(cls,
+		rows            : Iterable[dict],
+		conflict_fields : Iterable[str],
+		update_fields   : Iterable[str] = None,
+		chunk_size      : int           = 1000
+	) -> list[dict]:
+		"""
+		multi-row INSERT .. ON CONFLICT (conflict_fields) DO UPDATE on postgresql and sqlite,
+		INSERT .. ON DUPLICATE KEY UPDATE on mysql / mariadb (any unique key conflicts there),
+		select and update or insert per row on other dialects,
+		update_fields default to all inserted fields except conflict ones,
+		returns inserted and updated records
+		"""
+		dialects = {
+			'postgresql' : postgresql.insert,
+			'sqlite'     : sqlite.insert
+		}
+		dialect = Db.engine.dialect.name
+
+		conflict_fields = list(conflict_fields)
+		records         = []
+		for chunk in cls._chunks(rows, chunk_size):
+			fields = update_fields
+			if fields is None:
+				fields = [f for f in chunk[0] if f not in conflict_fields]
+
+			if dialect in dialects:
+				q = dialects[dialect](cls).values(chunk)
+				if fields:
+					q = q.on_conflict_do_update(
+						index_elements = conflict_fields,
+						set_           = {f: q.excluded[f] for f in fields}
+					)
+				else:
+					q = q.on_conflict_do_nothing(index_elements=conflict_fields)
+				records += await cls.fetch_all(q.returning(cls))
+			elif dialect in ('mysql', 'mariadb'):
+				records += await cls._upsert_duplicate_key(chunk, conflict_fields, fields)
+			else:
+				records += await cls._upsert_rows(chunk, conflict_fields, fields)
+		for record in records:
+			await cls._cache_record(record)
+		return records
+
+	@classmethod
+	async def _upsert_duplicate_key(cls,
+		chunk           : list[dict],
+		conflict_fields : list[str],
+		fields          : list[str]
+	) -> list[dict]:
+		"""
+		mysql has no RETURNING, records are selected back by conflict fields
+		"""
+		q = mysql.insert(cls).values(chunk)
+		q = q.on_duplicate_key_update({
+			f: q.inserted[f] for f in (fields or conflict_fields[:1]) # no-op update keeps the row
+		})
+		keys = tuple_(*[getattr(cls, f) for f in conflict_fields])
+		async with Db.session():
+			await cls.execute(q)
+			return await cls.fetch_all(
+				select(cls).where(keys.in_([tuple(row[f] for f in conflict_fields) for row in chunk]))
+			)
+
+	@classmethod
+	async def _upsert_rows(cls,
+		chunk           : list[dict],
+		conflict_fields : list[str],
+		fields          : list[str]
+	) -> list[dict]:
+		"""
+		dialects without upsert statement, one transaction per chunk,
+		concurrent inserts of the same keys may still fail on the unique constraint
+		"""
+		records = []
+		async with Db.session():
+			for row in chunk:
+				existing = await cls.get_one([getattr(cls, f) == row[f] for f in conflict_fields])
+				if existing is None:
+					records.append(await cls.create(row))
+				elif fields:
+					records.append(await cls.update(
+						existing[cls.__pk_field__],
+						{f: row[f] for f in fields}
+					))
+				else:
+					records.append(existing)
+		return records
+
+	@classmethod
+	@_traced
 	async def update(cls, pk: Any, to_update: dict) -> dict:
-		return await cls.fetch_one(
-			update(cls)
-				.where(getattr(cls, cls.__pk_field__) == pk)
-				.values(**to_update)
-				.returning(cls)
-		)
+		q, params = cls._q_update(to_update, returning=True)
+		record    = await cls.fetch_one(q, {'_pk': pk, **params})
+		if record:
+			await cls._cache_record(record)
+		else:
+			await cls._invalidate_record(pk)
+		return record
 
 	@classmethod
-	async def get_by(cls, field: str, value: Any) -> dict | None:
-		return await cls.fetch_one(
+	async def update_later(cls, pk: Any, to_update: dict):
+		"""
+		buffered update through __write_behind__,
+		updates right away when the Model has no buffer
+		"""
+		if cls.__write_behind__ is None:
+			await cls.update(pk, to_update)
+		else:
+			cls.__write_behind__.add(pk, to_update)
+
+	@classmethod
+	@_traced
+	async def _flush_updates(cls, pending: dict[Any, dict]):
+		"""
+		executemany per set of updated fields, all in one transaction
+		"""
+		groups: dict[tuple, tuple[Update, list[dict]]] = {}
+		single: list[tuple[Update, dict]]              = [] # updates with SQL expressions
+		for pk, to_update in pending.items():
+			q, params = cls._q_update(to_update)
+			if len(params) < len(to_update):
+				single.append((q, {'_pk': pk, **params}))
+			else:
+				groups.setdefault(tuple(sorted(to_update)), (q, []))[1].append({'_pk': pk, **params})
+
+		async with Db.session():
+			for q, params in (*groups.values(), *single):
+				await cls.execute(q, params)
+
+		for pk in pending:
+			await cls._invalidate_record(pk)
+
+	@classmethod
+	def _q_update(cls, to_update: dict, returning: bool = False) -> tuple[Update, dict]:
+		"""
+		update by `_pk` with plain values bound as `_set_{field}`,
+		SQL expressions (User.visits + 1, func.now()) are rendered inline,
+		so such statements are built per call instead of cached
+		"""
+		values = {f: v for f, v in to_update.items() if not isinstance(v, ColumnElement)}
+		inline = {f: v for f, v in to_update.items() if isinstance(v, ColumnElement)}
+		fields = tuple(sorted(values))
+
+		def build() -> Update:
+			q = (
+				update(cls)
+					.where(getattr(cls, cls.__pk_field__) == bindparam('_pk'))
+					.values({**{f: bindparam(f'_set_{f}') for f in fields}, **inline})
+			)
+			return q.returning(cls) if returning else q
+
+		q = build() if inline else cls.statement('update' if returning else 'update_many', fields, build)
+		return q, {f'_set_{f}': v for f, v in values.items()}
+
+	@classmethod
+	def _q_get_by(cls, field: str) -> Select:
+		return cls.statement('get_by', (field,), lambda: (
 			select(cls)
-				.where(getattr(cls, field) == value)
+				.where(getattr(cls, field) == bindparam('_value'))
 				.limit(1)
-		)
+		))
 
 	@classmethod
-	async def get_one(cls, filters: Iterable = None) -> dict | None:
+	@_traced
+	async def get_by(cls, field: str, value: Any) -> dict | None:
+		if value is None: # IS NULL, a bound None would compare `= NULL`
+			return await cls.fetch_one(select(cls).where(getattr(cls, field).is_(None)).limit(1))
+
+		cache = None if Db.in_session() else cls._record_cache(field) # no pre-commit rows in cache
+		if cache and (record := await cache.get(field, value)) is not None:
+			return record
+		generation = cache.generation if cache else None
+
+		if loader := cls._loader(field):
+			if record := await loader.load(value):
+				record = record.copy() # shared by de-duplicated awaiters
+		else:
+			record = await cls.fetch_one(cls._q_get_by(field), {'_value': value})
+		if cache and record:
+			await cls._cache_record(record, generation)
+		return record
+
+	@classmethod
+	@_traced
+	async def get_one(cls,
+		filters : Iterable      = None,
+		columns : Iterable[str] = None
+	) -> dict | None:
 		return await cls.fetch_one(
-			cls.q_filter(select(cls), filters)
+			cls.q_filter(cls.q_select(columns), filters)
 				.limit(1)
 		)
 
 	@classmethod
-	async def get_one_with_join(cls, tables: Iterable[str], filters: Iterable = None) -> dict | None:
+	@_traced
+	async def get_one_with_join(cls,
+		tables          : Iterable[str],
+		filters         : Iterable                 = None,
+		columns         : Iterable[str]            = None,
+		related_columns : dict[str, Iterable[str]] = None
+	) -> dict | None:
 		if res := await cls.fetch_one(
-			cls.q_join(tables, filters)
+			cls.q_join(tables, filters, columns, related_columns)
 				.limit(1)
 		):
 			return cls.normalize_joined(tables, res)
 		return None
 
 	@classmethod
+	@_traced
 	async def get_all(cls) -> list[dict]:
 		return await cls.fetch_all(select(cls))
 
 	@classmethod
-	async def get_many(cls, filters: Iterable = None) -> list[dict]:
-		return await cls.fetch_all(cls.q_filter(select(cls), filters))
+	@_traced
+	async def get_many(cls,
+		filters : Iterable      = None,
+		columns : Iterable[str] = None
+	) -> list[dict]:
+		return await cls.fetch_all(cls.q_filter(cls.q_select(columns), filters))
+
+	@classmethod
+	@_traced
+	async def get_page(cls,
+		filters  : Iterable      = None,
+		limit    : int           = None,
+		offset   : int           = None,
+		order_by : str           = None,
+		asc      : bool          = True,
+		columns  : Iterable[str] = None,
+		estimate : bool          = False
+	) -> tuple[list[dict], int]:
+		"""
+		page of records and total count of filtered rows in one query
+		via `count(*) OVER ()`, with `estimate` total is taken
+		from planner statistics instead of an exact count
+		"""
+		if not order_by:
+			order_by = cls.__time_order_field__
+
+		keys = (getattr(cls, order_by), getattr(cls, cls.__pk_field__)) # pk as tie-break
+		q    = cls.q_filter(cls.q_select(columns), filters)
+		page = (
+			q.order_by(*[k.asc() if asc else k.desc() for k in keys])
+				.limit(limit)
+				.offset(offset)
+		)
+
+		if estimate:
+			return await cls.fetch_all(page), await cls.fetch_estimated_count(q)
+
+		records = await cls.fetch_all(page.add_columns(func.count().over().label('_total')))
+		if not records:
+			return records, await cls.fetch_count(q) if offset else 0
+
+		total = records[0]['_total']
+		for record in records:
+			del record['_total']
+		return records, total
+
+	@classmethod
+	@_traced
+	async def get_columns(cls,
+		filters : Iterable      = None,
+		columns : Iterable[str] = None,
+		output  : str           = 'numpy'
+	) -> dict[str, Any] | Any:
+		q = cls.q_filter(
+			select(*[getattr(cls, c) for c in columns]) if columns else select(cls),
+			filters
+		)
+		return await cls.fetch_columns(q, output=output)
 
 	@classmethod
-	async def get_many_with_join(cls, tables: Iterable[str], filters: Iterable = None) -> list[dict]:
+	@_traced
+	async def get_many_with_join(cls,
+		tables          : Iterable[str],
+		filters         : Iterable                 = None,
+		columns         : Iterable[str]            = None,
+		related_columns : dict[str, Iterable[str]] = None,
+		adapter         : 'TypeAdapter'            = None
+	) -> list[dict] | Any:
 		return cls.normalize_joined_list(tables, await cls.fetch_all(
-			cls.q_join(tables, filters)
-		))
+			cls.q_join(tables, filters, columns, related_columns)
+		), adapter)
+
+	@classmethod
+	@_traced
+	async def iter_chunks(cls,
+		filters    : Iterable = None,
+		chunk_size : int      = 1000
+	) -> AsyncIterator[list[dict]]:
+		async for records in cls.stream(cls.q_filter(select(cls), filters), chunk_size):
+			yield records
+
+	@classmethod
+	@_traced
+	async def iter_many(cls,
+		filters    : Iterable = None,
+		chunk_size : int      = 1000
+	) -> AsyncIterator[dict]:
+		async for records in cls.iter_chunks(filters, chunk_size):
+			for record in records:
+				yield record
+
+	@classmethod
+	@_traced
+	async def iter_many_with_join(cls,
+		tables     : Iterable[str],
+		filters    : Iterable = None,
+		chunk_size : int      = 1000
+	) -> AsyncIterator[dict]:
+		async for records in cls.stream(cls.q_join(tables, filters), chunk_size):
+			for record in cls.normalize_joined_list(tables, records):
+				yield record
 
 	@classmethod
+	@_traced
 	async def get_many_last(cls,
 		limit    : int  = None,
 		order_by : str  = None,
@@ -250,17 +1073,74 @@ class Model:
 		return await cls.fetch_all(q)
 
 	@classmethod
+	@_traced
+	async def get_many_by_cursor(cls,
+		limit    : int,
+		cursor   : str           = None,
+		filters  : Iterable      = None,
+		tables   : Iterable[str] = None,
+		order_by : str           = None,
+		asc      : bool          = False
+	) -> tuple[list[dict], str | None]:
+		"""
+		keyset pagination over (order_by, __pk_field__),
+		returns page and cursor of the next page (None on the last one),
+		rows with NULL `order_by` are skipped as NULL can not be compared
+		in the row value, a cursor only fits the ordering it was issued for
+		"""
+		if not order_by:
+			order_by = cls.__time_order_field__
+
+		keys  = (getattr(cls, order_by), getattr(cls, cls.__pk_field__))
+		order = (order_by, asc)
+		q     = cls.q_join(tables, filters) if tables else cls.q_filter(select(cls), filters)
+		q     = q.where(keys[0].is_not(None))
+
+		if cursor:
+			row, value = tuple_(*keys), tuple_(*cls.decode_cursor(cursor, order, len(keys)))
+			q = q.where(row > value if asc else row < value)
+
+		q = q.order_by(*[k.asc() if asc else k.desc() for k in keys]).limit(limit + 1)
+
+		records     = await cls.fetch_all(q)
+		next_cursor = None
+		if len(records) > limit:
+			records     = records[:limit]
+			last        = records[-1]
+			next_cursor = cls.encode_cursor((last[order_by], last[cls.__pk_field__]), order)
+
+		if tables:
+			records = cls.normalize_joined_list(tables, records)
+		return records, next_cursor
+
+	@classmethod
+	@_traced
 	async def exists(cls, field: str, value: Any) -> bool:
+		if value is None: # IS NULL, a bound None would compare `= NULL`
+			return await cls.fetch_exists(select(exists().where(getattr(cls, field).is_(None))))
+
+		cache = None if Db.in_session() else cls._record_cache(field)
+		if cache and await cache.get(field, value) is not None:
+			return True
+		if loader := cls._loader(field):
+			return await loader.load(value) is not None
+
 		return await cls.fetch_exists(
-			select(
+			cls.statement('exists', (field,), lambda: select(
 				exists()
-					.where(getattr(cls, field) == value)
-			)
+					.where(getattr(cls, field) == bindparam('_value'))
+			)),
+			{'_value': value}
 		)
 
 	@classmethod
+	@_traced
 	async def delete(cls, pk: Any):
 		await cls.execute(
-			delete(cls)
-				.where(getattr(cls, cls.__pk_field__) == pk)
+			cls.statement('delete', (), lambda: (
+				delete(cls)
+					.where(getattr(cls, cls.__pk_field__) == bindparam('_pk'))
+			)),
+			{'_pk': pk}
 		)
+		await cls._invalidate_record(pk)
@@ -0,0 +1,211 @@
+import asyncio
+
+from time                 import monotonic, time
+from typing               import Any, Iterable
+from uuid                 import uuid4
+
+from redis.asyncio.client import Redis
+from loguru               import logger
+
+from .user_connection     import UserConnectionPool
+
+
+class Presence:
+	"""
+	cluster-wide presence: redis hash `presence:{user_id}` of node: expiry timestamp,
+	every node refreshes entries of its own users by heartbeat,
+	entries of a dead node expire after `ttl` seconds
+
+	await Presence.setup(RedisChannel.connection, ttl=30, cache_ttl=1)
+	online = await Presence.online_many(user_ids) # {user_id: bool}, one round trip
+	"""
+	connection : Redis | None                    = None
+	node       : str                             = ''
+	ttl        : float                           = 30
+	cache_ttl  : float                           = 1
+	cache_size : int                             = 100_000
+
+	_local     : set[int]                        = set() # users online on this node
+	_changes   : dict[int, bool]                 = {}    # user_id: online, not written yet
+	_cache     : dict[int, tuple[float, bool]]   = {}    # user_id: (expires, online)
+	_wake      : asyncio.Event | None            = None
+	_task      : asyncio.Task | None             = None
+
+	hits       : int = 0
+	misses     : int = 0
+
+	@staticmethod
+	async def setup(
+		connection : Redis,
+		ttl        : float = 30,
+		cache_ttl  : float = 1,
+		cache_size : int   = 100_000,
+		node       : str   = None
+	):
+		"""
+		:ttl       seconds a node entry lives without heartbeat
+		:cache_ttl seconds a remote presence answer is reused locally
+		"""
+		await Presence.close()
+		Presence.connection = connection
+		Presence.node       = node or str(uuid4())
+		Presence.ttl        = ttl
+		Presence.cache_ttl  = cache_ttl
+		Presence.cache_size = cache_size
+		Presence._wake      = asyncio.Event()
+		Presence._task      = asyncio.create_task(Presence._run())
+
+		if Presence._online not in UserConnectionPool.on_online:
+			UserConnectionPool.on_online.append(Presence._online)
+			UserConnectionPool.on_offline.append(Presence._offline)
+		for user_id in UserConnectionPool._pools:
+			Presence._online(user_id)
+
+	@staticmethod
+	async def close():
+		if Presence._task is None:
+			return
+		Presence._task.cancel()
+		try:
+			await Presence._task
+		except asyncio.CancelledError:
+			pass
+		Presence._task = None
+
+		try:
+			pipe = Presence.connection.pipeline(transaction=False)
+			for user_id in Presence._local | set(Presence._changes):
+				pipe.hdel(Presence._key(user_id), Presence.node)
+			await pipe.execute()
+		except Exception as e:
+			logger.error(f'An error occurred while presence closing: {e}')
+		Presence._local.clear()
+		Presence._changes.clear()
+		Presence._cache.clear()
+
+	@staticmethod
+	def _key(user_id: int) -> str:
+		return f'presence:{user_id}'
+
+	#################### LOCAL CHANGES ####################
+
+	@staticmethod
+	def _online(user_id: int):
+		Presence._set(user_id, True)
+
+	@staticmethod
+	def _offline(user_id: int):
+		Presence._set(user_id, False)
+
+	@staticmethod
+	def _set(user_id: int, online: bool):
+		if online:
+			Presence._local.add(user_id)
+		else:
+			Presence._local.discard(user_id)
+		Presence._cache.pop(user_id, None)
+		Presence._changes[user_id] = online
+		if Presence._wake is not None:
+			Presence._wake.set()
+
+	#################### WRITER ####################
+	# one task writes changes in order and refreshes local users every ttl / 3
+
+	@staticmethod
+	async def _run():
+		interval = Presence.ttl / 3
+		deadline = monotonic() + interval
+		while True:
+			try:
+				await asyncio.wait_for(Presence._wake.wait(), max(deadline - monotonic(), 0))
+			except asyncio.TimeoutError:
+				pass
+			Presence._wake.clear()
+
+			heartbeat = monotonic() >= deadline
+			if heartbeat:
+				deadline = monotonic() + interval
+			try:
+				await Presence._write(heartbeat)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f'Presence write error: {e}')
+				await asyncio.sleep(1)
+
+	@staticmethod
+	async def _write(heartbeat: bool):
+		changes, Presence._changes = Presence._changes, {}
+		if heartbeat:
+			changes = {**{user_id: True for user_id in Presence._local}, **changes}
+		if not changes:
+			return
+
+		expires = time() + Presence.ttl
+		pipe    = Presence.connection.pipeline(transaction=False)
+		for user_id, online in changes.items():
+			key = Presence._key(user_id)
+			if online:
+				pipe.hset(key, Presence.node, expires)
+				pipe.expire(key, int(Presence.ttl) + 1)
+			else:
+				pipe.hdel(key, Presence.node)
+		try:
+			await pipe.execute()
+		except BaseException:
+			for user_id, online in changes.items(): # changes made meanwhile win
+				Presence._changes.setdefault(user_id, online)
+			raise
+
+	#################### QUERIES ####################
+
+	@staticmethod
+	async def online_many(user_ids: Iterable[int]) -> dict[int, bool]:
+		"""
+		local users and cached answers first, the rest in one pipeline
+		"""
+		now     = monotonic()
+		result  = {}
+		missing = []
+		for user_id in user_ids:
+			if user_id in Presence._local:
+				result[user_id] = True
+			elif (entry := Presence._cache.get(user_id)) and entry[0] >= now:
+				result[user_id] = entry[1]
+				Presence.hits  += 1
+			else:
+				missing.append(user_id)
+		if not missing:
+			return result
+
+		Presence.misses += len(missing)
+		pipe = Presence.connection.pipeline(transaction=False)
+		for user_id in missing:
+			pipe.hvals(Presence._key(user_id))
+		rows = await pipe.execute()
+
+		timestamp = time()
+		expires   = now + Presence.cache_ttl
+		if len(Presence._cache) + len(missing) > Presence.cache_size:
+			Presence._cache.clear()
+		for user_id, values in zip(missing, rows):
+			online = any(float(value) > timestamp for value in values)
+			result[user_id]          = online
+			Presence._cache[user_id] = (expires, online)
+		return result
+
+	@staticmethod
+	async def is_online(user_id: int) -> bool:
+		return (await Presence.online_many((user_id,)))[user_id]
+
+	@staticmethod
+	def stats() -> dict[str, Any]:
+		total = Presence.hits + Presence.misses
+		return {
+			'local'    : len(Presence._local),
+			'pending'  : len(Presence._changes),
+			'cached'   : len(Presence._cache),
+			'hits'     : Presence.hits,
+			'misses'   : Presence.misses,
+			'hit_rate' : Presence.hits / total if total else 0.0
+		}
@@ -1,22 +1,118 @@
 import asyncio
+import re
+import zlib
 
-from typing               import Union
+from time                 import time
+from typing               import Awaitable, Callable, Iterable, Union
+from uuid                 import uuid4
 
 from redis.asyncio.client import Redis
 from loguru               import logger
 
-from .event               import Event
-from .user_connection     import UserConnectionPool
+from .event               import Event, EventPayload
+from .user_connection     import UserConnection, UserConnectionPool
+
+
+class RedisSubscriber:
+	"""
+	node-level pubsub connection multiplexing many channels,
+	blocks until a message arrives and routes it to the channel handler,
+	channels are spread over `shards` connections by hash
+	"""
+	shards : list['RedisSubscriber'] = []
+
+	@staticmethod
+	async def setup(connection: Redis, shards: int = 1):
+		await RedisSubscriber.close_all()
+		for index in range(shards):
+			subscriber = RedisSubscriber(connection, index)
+			await subscriber.start()
+			RedisSubscriber.shards.append(subscriber)
+
+	@staticmethod
+	def get(channel: str) -> 'RedisSubscriber':
+		shards = RedisSubscriber.shards
+		return shards[zlib.crc32(channel.encode()) % len(shards)]
+
+	@staticmethod
+	async def close_all():
+		shards, RedisSubscriber.shards = RedisSubscriber.shards, []
+		for subscriber in shards:
+			await subscriber.close()
+
+	########################################################
+
+	def __init__(self, connection: Redis, index: int):
+		self.pubsub   = connection.pubsub()
+		self.handlers : dict[str, Callable[[bytes], Awaitable]] = {} # channel: handler
+		self.control  = f'puerpy:node:{uuid4()}:{index}' # keeps connection subscribed while idle
+		self.task     = None
+
+	async def start(self):
+		await self.pubsub.subscribe(self.control)
+		self.task = asyncio.create_task(self._listen())
+
+	async def _listen(self):
+		while True:
+			try:
+				message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f'Redis subscriber error: {e}')
+				await asyncio.sleep(1)
+				continue
+
+			if not message:
+				continue
+			channel = message['channel']
+			if isinstance(channel, bytes):
+				channel = channel.decode('utf-8')
+			if handler := self.handlers.get(channel):
+				try:
+					await handler(message['data'])
+				except Exception as e:
+					logger.error(f'Redis channel {channel} handler error: {e}')
+
+	async def subscribe(self, channel: str, handler: Callable[[bytes], Awaitable]):
+		self.handlers[channel] = handler
+		await self.pubsub.subscribe(channel)
+
+	async def unsubscribe(self, channel: str):
+		self.handlers.pop(channel, None)
+		await self.pubsub.unsubscribe(channel)
+
+	async def close(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+		try:
+			await self.pubsub.unsubscribe()
+			await self.pubsub.close()
+		except Exception as e:
+			logger.error(f'An error occurred while redis subscriber closing: {e}')
 
 
 class RedisChannel:
-	channels   : dict[int: 'RedisChannel'] = {} # 'user_id' : RedisChannel
-	connection : Redis
+	channels      : dict[int: 'RedisChannel'] = {} # 'user_id' : RedisChannel
+	topics        : dict[str, set[int]]       = {} # 'topic' : local member user ids
+	connection    : Redis
+	stream_maxlen : int | None                = None
 
 	@staticmethod
-	async def setup_connection(**kwargs):
-		RedisChannel.connection = Redis(**kwargs)
+	async def setup_connection(shards: int = 1, stream_maxlen: int | None = None, **kwargs):
+		"""
+		:shards        number of node-level pubsub connections for all user channels
+		:stream_maxlen also keep about this many last events per channel
+		               in redis streams, so reconnecting clients can replay the gap
+		"""
+		RedisChannel.connection    = Redis(**kwargs)
+		RedisChannel.stream_maxlen = stream_maxlen
 		await RedisChannel.connection.ping()
+		await RedisSubscriber.setup(RedisChannel.connection, shards)
 
 	@staticmethod
 	def get(
@@ -29,45 +125,179 @@ class RedisChannel:
 			RedisChannel.channels[user_id] = channel
 		return channel
 
+	@staticmethod
+	async def write_many(user_ids: Iterable[int], event: Event | EventPayload):
+		"""
+		serializes event once and publishes it to every user channel in one pipeline
+		"""
+		await RedisChannel._publish([str(user_id) for user_id in user_ids], event)
+
+	@staticmethod
+	async def _publish(names: list[str], event: Event | EventPayload):
+		payload = EventPayload.of(event)
+		pipe    = RedisChannel.connection.pipeline(transaction=False)
+		stamp   = {} if UserConnectionPool.metrics is None else {'published_at': time()} # publish-to-socket latency
+		if RedisChannel.stream_maxlen is None:
+			message = payload.with_meta(**stamp).text if stamp else payload.text
+			for name in names:
+				pipe.publish(name, message)
+			await pipe.execute()
+			return
+
+		for name in names:
+			pipe.xadd(
+				RedisChannel._stream_key(name),
+				{'event': payload.text},
+				maxlen      = RedisChannel.stream_maxlen,
+				approximate = True
+			)
+		stream_ids = await pipe.execute()
+		for name, stream_id in zip(names, stream_ids):
+			pipe.publish(name, payload.with_meta(stream_id=stream_id.decode('utf-8'), **stamp).text) # not stamped in the stream, replays are not latency
+		await pipe.execute()
+
+	#################### STREAMS ####################
+	# every published event is also appended to `stream:{channel}`
+	# and carries its entry id in meta.stream_id
+
+	@staticmethod
+	def _stream_key(name: str) -> str:
+		return f'stream:{name}'
+
+	_stream_id_format = re.compile(r'\d+(-\d+)?')
+
+	@staticmethod
+	def _stream_id(stream_id: str) -> tuple[int, int] | None:
+		"""
+		None for anything but a valid `ms-seq` entry id
+		"""
+		if not isinstance(stream_id, str) or not RedisChannel._stream_id_format.fullmatch(stream_id):
+			return None
+		ms, _, seq = stream_id.partition('-')
+		return int(ms), int(seq or 0)
+
+	@staticmethod
+	async def _replay(
+		name    : str,
+		last_id : str,
+		send    : Callable[[EventPayload], Awaitable[bool]],
+		count   : int = 1000
+	) -> bool:
+		"""
+		False without streams, for a malformed `last_id` or when `send` could not deliver,
+		the client reloads then, `send` waits for queue space, so nothing is dropped by overflow
+		"""
+		if RedisChannel.stream_maxlen is None or (last := RedisChannel._stream_id(last_id)) is None:
+			return False
+
+		key      = RedisChannel._stream_key(name)
+		first    = await RedisChannel.connection.xrange(key, count=1)
+		complete = not first or ( # the oldest kept entry follows last_id, across milliseconds a reload is asked for
+			RedisChannel._stream_id(first[0][0].decode('utf-8')) <= (last[0], last[1] + 1)
+		)
+		while True:
+			response = await RedisChannel.connection.xread({key: last_id}, count=count)
+			entries  = response[0][1] if response else []
+			for stream_id, fields in entries:
+				last_id = stream_id.decode('utf-8')
+				if not await send(EventPayload(fields[b'event'].decode('utf-8')).with_meta(stream_id=last_id)):
+					return False
+			if len(entries) < count:
+				return complete
+
+	@staticmethod
+	async def replay_topic(topic: str, last_id: str, connection: UserConnection) -> bool:
+		return await RedisChannel._replay(RedisChannel._topic_channel(topic), last_id, connection.put)
+
+	#################### TOPICS ####################
+	# a node subscribes to a topic once and delivers to its local members,
+	# so a broadcast costs one PUBLISH and one message per node
+
+	@staticmethod
+	def _topic_channel(topic: str) -> str:
+		return f'topic:{topic}'
+
+	@staticmethod
+	async def join(topic: str, user_id: int):
+		members = RedisChannel.topics.get(topic)
+		if members is None:
+			members = RedisChannel.topics[topic] = set()
+			channel = RedisChannel._topic_channel(topic)
+			await RedisSubscriber.get(channel).subscribe(
+				channel,
+				lambda data: RedisChannel._read_topic(topic, data)
+			)
+		members.add(user_id)
+
+	@staticmethod
+	async def leave(topic: str, user_id: int):
+		members = RedisChannel.topics.get(topic)
+		if members is None:
+			return
+		members.discard(user_id)
+		if not members:
+			del RedisChannel.topics[topic]
+			channel = RedisChannel._topic_channel(topic)
+			await RedisSubscriber.get(channel).unsubscribe(channel)
+
+	@staticmethod
+	async def write_topic(topic: str, event: Event | EventPayload):
+		await RedisChannel._publish([RedisChannel._topic_channel(topic)], event)
+
+	@staticmethod
+	async def _read_topic(topic: str, data: bytes):
+		if metrics := UserConnectionPool.metrics:
+			metrics.redis_in += 1
+		event = EventPayload(data.decode('utf-8'))
+		for user_id in tuple(RedisChannel.topics.get(topic, ())):
+			if pool := UserConnectionPool.get_by_id(user_id):
+				await pool.send(event)
+
 	########################################################
 
 	def __init__(self, user_id: int):
 		self.user_id    = user_id
-		self.pubsub     = None
+		self.name       = str(user_id)
 		self.is_reading = False
-		self.task       = None
 
-	async def _read(self):
-		while True:
-			message = await self.pubsub.get_message(ignore_subscribe_messages=True)
-			if message:
-				event  = message['data'].decode('utf-8')
-				if pool := UserConnectionPool.get_by_id(self.user_id):
-					await pool.send(event)
-			await asyncio.sleep(0.01)
+	async def _read(self, data: bytes):
+		if metrics := UserConnectionPool.metrics:
+			metrics.redis_in += 1
+		if pool := UserConnectionPool.get_by_id(self.user_id):
+			await pool.send(EventPayload(data.decode('utf-8')))
 
 	########################################################
 
 	async def read(self):
 		if not self.is_reading:
-			self.pubsub = RedisChannel.connection.pubsub()
-			await self.pubsub.subscribe(str(self.user_id))
-			self.task       = asyncio.create_task(self._read())
 			self.is_reading = True
+			await RedisSubscriber.get(self.name).subscribe(self.name, self._read)
+
+	async def write(self, event: Event | EventPayload):
+		await RedisChannel._publish([self.name], event)
 
-	async def write(self, event: Event):
-		await RedisChannel.connection.publish(str(self.user_id), event.model_dump_json())
+	async def replay(self, last_id: str, connection: UserConnection | None = None) -> bool:
+		"""
+		sends events written after `last_id` (meta.stream_id of the last event the client got)
+		to `connection` or to all connections of the user, requires stream_maxlen,
+		call after read() so nothing falls in between, clients skip stream ids already seen,
+		returns False when a part of the gap was trimmed, `last_id` is malformed
+		or streams are off, the client has to reload then
+		"""
+		if connection is None:
+			if not (pool := UserConnectionPool.get_by_id(self.user_id)):
+				return True
+			return await RedisChannel._replay(self.name, last_id, pool.put)
+		return await RedisChannel._replay(self.name, last_id, connection.put)
 
 	async def close(self):
 		del RedisChannel.channels[self.user_id]
 		try:
-			if self.task:
-				self.task.cancel()
-				try:
-					await self.task
-				except asyncio.CancelledError:
-					pass
-			await self.pubsub.unsubscribe()
-			await self.pubsub.close()
+			for topic, members in list(RedisChannel.topics.items()):
+				if self.user_id in members:
+					await RedisChannel.leave(topic, self.user_id)
+			if self.is_reading:
+				self.is_reading = False
+				await RedisSubscriber.get(self.name).unsubscribe(self.name)
 		except Exception as e:
 			logger.error(f'An error occurred while redis disconnect: {e}')
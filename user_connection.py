@@ -1,38 +1,251 @@
-from typing             import Awaitable
+import asyncio
+
+from typing             import Awaitable, Callable, Iterable
 from uuid               import uuid4
 
-from fastapi.websockets import WebSocketState, WebSocket
+from fastapi.websockets import WebSocketDisconnect, WebSocketState, WebSocket
 from loguru             import logger
 
-from .event             import Event
+from .event             import Event, EventBatch, EventPayload
+from .inbound           import Dispatcher
+from .metrics           import Histogram, RealtimeMetrics
+
+
+class Coalesce:
+    """
+    packs events arriving within `window` seconds into one array frame
+    of at most `max_count` events / `max_bytes` of json,
+    events named in `latest` with the same meta[key] collapse to the newest one,
+    UserConnection.queue_size has to hold a window worth of events
+
+    UserConnectionPool.connect(user_id, websocket, on_event, coalesce=Coalesce(
+        window = 0.05,
+        names  = ('price', 'status'), # None for all events
+        latest = ('price',)
+    ))
+    """
+    def __init__(self,
+        window    : float                = 0.05,
+        max_count : int                  = 100,
+        max_bytes : int                  = 64 * 1024,
+        names     : Iterable[str] | None = None,
+        latest    : Iterable[str]        = (),
+        key       : str                  = 'id'
+    ):
+        self.window    = window
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.names     = None if names is None else frozenset(names)
+        self.latest    = frozenset(latest)
+        self.key       = key
+
+    def is_batched(self, event: EventPayload) -> bool:
+        return self.names is None or event.name in self.names
+
+    def collapse_key(self, event: EventPayload) -> tuple | None:
+        if event.name in self.latest and (value := event.meta.get(self.key)) is not None:
+            return event.name, value
+        return None
 
 
 class UserConnection:
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    DISCONNECT  = 'disconnect'
+
+    queue_size : int               = 256
+    overflow   : str               = DROP_OLDEST
+    coalesce   : Coalesce | None   = None
+    dispatcher : Dispatcher | None = None
+
+    _closing   : set[asyncio.Task] = set() # keeps closing tasks alive
+
+    @staticmethod
+    def setup(
+        queue_size : int               = 256,
+        overflow   : str               = DROP_OLDEST,
+        coalesce   : Coalesce | None   = None,
+        dispatcher : Dispatcher | None = None
+    ):
+        """
+        :queue_size outbound events buffered per connection
+        :overflow   what to do when a slow client fills the queue:
+                    drop_oldest | drop_newest | disconnect
+        :coalesce   default frame batching of connections, see Coalesce
+        :dispatcher default concurrent handling of inbound events, see Dispatcher,
+                    without it listen() awaits on_event before reading the next frame
+        """
+        if overflow not in (UserConnection.DROP_OLDEST, UserConnection.DROP_NEWEST, UserConnection.DISCONNECT):
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        UserConnection.queue_size = queue_size
+        UserConnection.overflow   = overflow
+        UserConnection.coalesce   = coalesce
+        UserConnection.dispatcher = dispatcher
+
     def __init__(self,
-        pool      : 'UserConnectionPool',
-        user_id   : int,
-        websocket : WebSocket,
-        on_event  : Awaitable
+        pool       : 'UserConnectionPool',
+        user_id    : int,
+        websocket  : WebSocket,
+        on_event   : Awaitable,
+        binary     : bool              = False,
+        coalesce   : Coalesce | None   = None,
+        dispatcher : Dispatcher | None = None
     ):
         self.socket: WebSocket = websocket
         self.on_event          = on_event
         self.pool              = pool
         self.user_id           = user_id
+        self.binary            = binary # msgpack frames instead of json text
+        self.coalesce          = coalesce or UserConnection.coalesce
+        self.dispatcher        = dispatcher or UserConnection.dispatcher
+        self.inbox             = self.dispatcher.inbox(self) if self.dispatcher else None
         self.id                = str(uuid4())
+        self.queue             = asyncio.Queue(UserConnection.queue_size)
+        self.writer            = None
+        self.closing           : asyncio.Task | None = None
+        self.dropped           = 0
+        self.collapsed         = 0
 
     async def listen(self):
         while True:
-            data  = await self.socket.receive_json()
-            event = Event(**data)
-            await self.on_event(self.user_id, event)
+            message = await self.socket.receive()
+            if message['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(message.get('code', 1000), message.get('reason'))
+            if (text := message.get('text')) is not None:
+                event = Event.model_validate_json(text)
+            else:
+                event = Event.from_msgpack(message['bytes'])
+
+            if metrics := UserConnectionPool.metrics:
+                metrics.messages_in += 1
+
+            if self.inbox is None:
+                await self.on_event(self.user_id, event)
+            elif not self.inbox.put(event) and self.dispatcher.overflow == Dispatcher.DISCONNECT:
+                logger.warning(f'Disconnecting flooding client {self.id} of user {self.user_id}')
+                await self.disconnect()
+                raise WebSocketDisconnect(1008, 'Too many events')
+
+    def enqueue(self, event: EventPayload) -> bool:
+        """
+        non-blocking, the event is sent by the connection writer task,
+        returns False when the event was dropped
+        """
+        if self.closing is not None:
+            return False
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._write())
 
-    async def send(self, event: str):
         try:
-            await self.socket.send_text(event)
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if metrics := UserConnectionPool.metrics:
+                metrics.dropped += 1
+
+        if UserConnection.overflow == UserConnection.DROP_OLDEST:
+            self.queue.get_nowait()
+            self.queue.put_nowait(event)
+            return True
+        if UserConnection.overflow == UserConnection.DISCONNECT:
+            logger.warning(f'Disconnecting slow consumer {self.id} of user {self.user_id}')
+            self._close()
+        return False
+
+    async def _write(self):
+        while True:
+            event = await self.queue.get()
+            if self.coalesce is not None and self.coalesce.is_batched(event):
+                batch, event = await self._collect(event)
+                await self._send_frame(batch if len(batch.events) > 1 else batch.events[0])
+                if event is None:
+                    continue
+            await self._send_frame(event)
+
+    async def _collect(self, event: EventPayload) -> tuple[EventBatch, EventPayload | None]:
+        """
+        waits one window and drains the queue into a batch,
+        returns the batch and the first event that can not be batched
+        """
+        coalesce = self.coalesce
+        batch    = {}
+        size     = 0
+        rest     = None
+        await asyncio.sleep(coalesce.window)
+
+        while True:
+            key = coalesce.collapse_key(event)
+            if key is None:
+                key = len(batch), None
+            elif superseded := batch.pop(key, None):
+                size -= len(superseded.text)
+                self.collapsed += 1
+            batch[key] = event
+            size += len(event.text)
+
+            if len(batch) >= coalesce.max_count or size >= coalesce.max_bytes or self.queue.empty():
+                break
+            event = self.queue.get_nowait()
+            if not coalesce.is_batched(event):
+                rest = event
+                break
+        return EventBatch(batch.values()), rest
+
+    async def _send_frame(self, event: EventPayload | EventBatch):
+        metrics = UserConnectionPool.metrics
+        try:
+            if self.binary:
+                await self.socket.send_bytes(event.binary)
+            else:
+                await self.socket.send_text(event.text)
         except Exception as e:
+            if metrics is not None:
+                metrics.send_failures += 1
             logger.error(f'Error while sending event to websocket: {e}')
+            return
+
+        if metrics is not None:
+            for sent in event.events if isinstance(event, EventBatch) else (event,):
+                metrics.sent(sent.published_at)
+
+    async def send(self, event: Event | EventPayload | str):
+        self.enqueue(EventPayload.of(event))
+
+    async def put(self, event: Event | EventPayload | str) -> bool:
+        """
+        waits for space in the queue instead of applying `overflow`, e.g. for replays,
+        returns False when the connection closes
+        """
+        if self.closing is not None:
+            return False
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._write())
+        await self.queue.put(EventPayload.of(event))
+        return self.closing is None
 
     async def disconnect(self) -> bool:
+        """
+        closes the connection once, repeated calls get the same result:
+        True when the pool is empty
+        """
+        return await asyncio.shield(self._close())
+
+    def _close(self) -> asyncio.Task:
+        if self.closing is None:
+            self.closing = asyncio.ensure_future(self._disconnect())
+            UserConnection._closing.add(self.closing)
+            self.closing.add_done_callback(UserConnection._closing.discard)
+        return self.closing
+
+    async def _disconnect(self) -> bool:
+        if self.writer:
+            self.writer.cancel()
+        while not self.queue.empty(): # wakes put() waiting for space
+            self.queue.get_nowait()
+        if self.inbox is not None:
+            self.inbox.close()
+
         if self.socket.client_state != WebSocketState.DISCONNECTED:
             try:
                 await self.socket.close()
@@ -42,19 +255,55 @@ class UserConnection:
 
 
 class UserConnectionPool:
-    _pools: dict[int, 'UserConnectionPool'] = {} # user_id: UserConnectionPool
+    _pools  : dict[int, 'UserConnectionPool'] = {} # user_id: UserConnectionPool
+    metrics : RealtimeMetrics | None          = None
+
+    # called with user_id when the first connection of a user opens on this node
+    # and when the last one closes, see Presence
+    on_online  : list[Callable[[int], None]] = []
+    on_offline : list[Callable[[int], None]] = []
 
     @staticmethod
     def connect(
-        user_id   : int,
-        websocket : WebSocket,
-        on_event  : Awaitable
+        user_id    : int,
+        websocket  : WebSocket,
+        on_event   : Awaitable,
+        binary     : bool              = False,
+        coalesce   : Coalesce | None   = None,
+        dispatcher : Dispatcher | None = None
     ) -> UserConnection:
+        """
+        :binary     send msgpack frames to the client instead of json text
+        :coalesce   batch events into array frames, see Coalesce
+        :dispatcher handle inbound events concurrently, see Dispatcher
+        """
         pool = UserConnectionPool.get_by_id(user_id)
         if not pool:
             pool = UserConnectionPool(user_id)
             UserConnectionPool._pools[user_id] = pool
-        return pool._add_connection(websocket, on_event)
+            UserConnectionPool._notify(UserConnectionPool.on_online, user_id)
+        return pool._add_connection(websocket, on_event, binary, coalesce, dispatcher)
+
+    @staticmethod
+    def instrument(
+        latency_buckets : Iterable[float] = Histogram.BUCKETS,
+        rate_window     : float           = 10
+    ) -> RealtimeMetrics:
+        """
+        enables realtime metrics of this node,
+        `UserConnectionPool.metrics = None` turns them off again
+        """
+        metrics = RealtimeMetrics(latency_buckets, rate_window)
+        metrics.gauge('online_users', lambda: len(UserConnectionPool._pools))
+        metrics.gauge('connections',  lambda: sum(len(p.connections) for p in UserConnectionPool._pools.values()))
+        metrics.backlogs = lambda: {c.id: c.queue.qsize() for c in UserConnectionPool._connections()}
+        UserConnectionPool.metrics = metrics
+        return metrics
+
+    @staticmethod
+    def _connections() -> Iterable[UserConnection]:
+        for pool in UserConnectionPool._pools.values():
+            yield from pool.connections.values()
 
     @staticmethod
     def is_online(user_id: int) -> bool:
@@ -65,6 +314,14 @@ class UserConnectionPool:
     def get_by_id(user_id: int) -> 'UserConnectionPool':
         return UserConnectionPool._pools.get(user_id)
 
+    @staticmethod
+    def _notify(listeners: list[Callable[[int], None]], user_id: int):
+        for listener in listeners:
+            try:
+                listener(user_id)
+            except Exception as e:
+                logger.error(f'Presence listener error: {e}')
+
     ########################################################
 
     def __init__(self, user_id: int):
@@ -72,10 +329,13 @@ class UserConnectionPool:
         self.connections: dict[str, UserConnection] = {} # connection_id: UserConnection
 
     def _add_connection(self,
-        websocket : WebSocket,
-        on_event  : Awaitable
+        websocket  : WebSocket,
+        on_event   : Awaitable,
+        binary     : bool              = False,
+        coalesce   : Coalesce | None   = None,
+        dispatcher : Dispatcher | None = None
     ) -> UserConnection:
-        connection = UserConnection(self, self.user_id, websocket, on_event)
+        connection = UserConnection(self, self.user_id, websocket, on_event, binary, coalesce, dispatcher)
         self.connections[connection.id] = connection
         return connection
 
@@ -83,6 +343,7 @@ class UserConnectionPool:
         del self.connections[connection_id]
         if not self._is_online:
             del UserConnectionPool._pools[self.user_id]
+            UserConnectionPool._notify(UserConnectionPool.on_offline, self.user_id)
             return True
         return False
 
@@ -90,6 +351,16 @@ class UserConnectionPool:
     def _is_online(self) -> bool:
         return bool(len(self.connections))
 
-    async def send(self, event: str):
+    async def send(self, event: Event | EventPayload | str):
+        payload = EventPayload.of(event) # serialized once for all connections
         for connection in self.connections.values():
-            await connection.send(event)
+            connection.enqueue(payload)
+
+    async def put(self, event: Event | EventPayload | str) -> bool:
+        """
+        waits for space in the queue of every connection, see UserConnection.put(),
+        returns False when a connection closed meanwhile
+        """
+        payload = EventPayload.of(event)
+        results = [await connection.put(payload) for connection in tuple(self.connections.values())]
+        return all(results)
@@ -0,0 +1,165 @@
+import asyncio
+
+from contextvars    import Context
+from typing         import Any, Awaitable, Callable
+
+from loguru         import logger
+from sqlalchemy.exc import DisconnectionError, InterfaceError
+
+
+class WriteBehind:
+	"""
+	buffers updates per pk, merges their fields and flushes them
+	in bulk every `interval` seconds or once `batch_size` pks are pending,
+	a failing batch is split down to single rows, a row failing
+	`max_attempts` flushes in a row is dropped and logged
+
+	class User(Base, Model):
+		__write_behind__ = WriteBehind(interval=1, batch_size=500)
+
+	await User.update_later(user_id, {'last_seen': now})
+	...
+	await WriteBehind.close_all() # on shutdown
+	"""
+	_instances : list['WriteBehind'] = []
+
+	def __init__(self, interval: float = 1, batch_size: int = 500, max_attempts: int = 5):
+		self.interval     = interval
+		self.batch_size   = batch_size
+		self.max_attempts = max_attempts
+		self.flusher      : Callable[[dict[Any, dict]], Awaitable] = None # bound by Model
+		self.name         = ''                                             # bound by Model
+
+		self._pending   : dict[Any, dict] = {} # pk: fields to update
+		self._attempts  : dict[Any, int]  = {} # pk: failed flushes of the row alone
+		self._lock      = asyncio.Lock()
+		self._task      : asyncio.Task | None = None
+		self._scheduled : asyncio.Task | None = None
+
+		self.enqueued  = 0
+		self.coalesced = 0
+		self.flushed   = 0
+		self.flushes   = 0
+		self.failures  = 0
+		self.dropped   = 0
+
+		WriteBehind._instances.append(self)
+
+	def add(self, pk: Any, to_update: dict):
+		self.enqueued += 1
+		if pending := self._pending.get(pk):
+			pending.update(to_update)
+			self.coalesced += 1
+		else:
+			self._pending[pk] = dict(to_update)
+
+		# tasks run in a context of their own, not in a Db.session() of the caller
+		if self._task is None or self._task.done():
+			self._task = Context().run(asyncio.ensure_future, self._run())
+		if len(self._pending) >= self.batch_size and (self._scheduled is None or self._scheduled.done()):
+			self._scheduled = Context().run(asyncio.ensure_future, self.flush())
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			await self.flush()
+
+	async def flush(self):
+		async with self._lock:
+			pending, self._pending = self._pending, {}
+			if not pending:
+				return
+			done = set()
+			try:
+				await self._write(pending, done)
+			except asyncio.CancelledError:
+				self._requeue({pk: fields for pk, fields in pending.items() if pk not in done})
+				raise
+
+	async def _write(self, pending: dict[Any, dict], done: set):
+		try:
+			await self.flusher(pending)
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			self.failures += 1
+			if self._is_transient(e): # the database is unreachable, splitting would not help
+				logger.error(f'Write-behind flush of {len(pending)} {self.name} rows failed: {e}')
+				self._requeue(pending)
+			elif len(pending) == 1:
+				self._fail(pending, e)
+			else:
+				rows = list(pending.items())
+				half = len(rows) // 2
+				await self._write(dict(rows[:half]), done)
+				await self._write(dict(rows[half:]), done)
+			return
+
+		self.flushes += 1
+		self.flushed += len(pending)
+		done.update(pending)
+		for pk in pending:
+			self._attempts.pop(pk, None)
+
+	@staticmethod
+	def _is_transient(e: Exception) -> bool:
+		return (
+			isinstance(e, (OSError, asyncio.TimeoutError, InterfaceError, DisconnectionError))
+			or isinstance(getattr(e, 'orig', None), (OSError, asyncio.TimeoutError))
+			or getattr(e, 'connection_invalidated', False)
+		)
+
+	def _fail(self, pending: dict[Any, dict], e: Exception):
+		(pk, fields), = pending.items()
+		attempts = self._attempts[pk] = self._attempts.get(pk, 0) + 1
+		if attempts < self.max_attempts:
+			logger.error(f'Write-behind update of {self.name} {pk} failed ({attempts}/{self.max_attempts}): {e}')
+			self._requeue(pending)
+			return
+		del self._attempts[pk]
+		self.dropped += 1
+		logger.error(f'Write-behind update of {self.name} {pk} dropped after {attempts} attempts: {fields}: {e}')
+
+	def _requeue(self, pending: dict[Any, dict]):
+		for pk, fields in pending.items(): # updates added meanwhile win
+			self._pending[pk] = {**fields, **self._pending.get(pk, {})}
+
+	async def close(self) -> dict[Any, dict]:
+		"""
+		flushes once more, returns rows left unflushed
+		"""
+		if self._task is not None:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		await self.flush()
+
+		unflushed, self._pending = self._pending, {}
+		if unflushed:
+			logger.error(f'Write-behind closed with {len(unflushed)} unflushed {self.name} rows: {unflushed}')
+		return unflushed
+
+	@staticmethod
+	async def close_all() -> dict[str, dict[Any, dict]]:
+		"""
+		unflushed rows by model name
+		"""
+		unflushed = {}
+		for buffer in WriteBehind._instances:
+			if rows := await buffer.close():
+				unflushed[buffer.name] = rows
+		return unflushed
+
+	def stats(self) -> dict[str, Any]:
+		return {
+			'pending'   : len(self._pending),
+			'enqueued'  : self.enqueued,
+			'coalesced' : self.coalesced,
+			'flushed'   : self.flushed,
+			'flushes'   : self.flushes,
+			'failures'  : self.failures,
+			'dropped'   : self.dropped
+		}